@@ -0,0 +1,382 @@
+"""
+benchmark
+    seeds a database with a synthetic question bank, drives every trivia
+    endpoint through the Flask test client and through a concurrent HTTP
+    load generator, and reports p50/p99 latency and throughput as JSON.
+
+    python benchmark.py --size 100000 --output results.json
+    python benchmark.py --size 100000 --baseline results.json
+    python benchmark.py --size 100000 --startup-runs 5
+
+    --startup-runs starts fresh interpreters against the seeded database
+    and reports the median import, create_app and time-to-first-request
+    of each read endpoint, which is what a cold worker pays.
+
+    without --database-uri a temporary SQLite file is used. with one
+    (e.g. a scratch Postgres database) its questions are replaced.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+from flaskr import create_app
+from models import db, Category, Question
+from migrations import upgrade
+from bulk import import_questions
+
+CATEGORIES = ('Science', 'Art', 'Geography', 'History', 'Entertainment', 'Sports')
+WORDS = (
+    'which', 'what', 'country', 'river', 'painter', 'team', 'planet', 'title',
+    'city', 'year', 'element', 'author', 'movie', 'mountain', 'battle', 'player',
+    'album', 'ocean', 'empire', 'theory', 'museum', 'record', 'league', 'island')
+
+
+class QuietRequestHandler(WSGIRequestHandler):
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+def synthetic_rows(size, seed):
+    generator = random.Random(seed)
+    for number in range(size):
+        words = generator.sample(WORDS, 6)
+        yield number + 1, {
+            'question': '{} {}?'.format(' '.join(words).capitalize(), number),
+            'answer': generator.choice(WORDS),
+            'category': number % len(CATEGORIES) + 1,
+            'difficulty': generator.randint(1, 5)
+        }
+
+
+def seed_database(app, size, seed):
+    with app.app_context():
+        upgrade()
+        Question.query.delete()
+        if Category.query.count() != len(CATEGORIES):
+            Category.query.delete()
+            for category in CATEGORIES:
+                db.session.add(Category(category))
+        db.session.commit()
+
+        inserted, errors = import_questions(synthetic_rows(size, seed), 5000)
+        return inserted
+
+
+def scenarios(app, seed):
+    """
+    one (name, request factory, success callback) per endpoint. the
+    factory returns (method, path, json body). mutations create their own
+    rows, so the delete scenario deletes what the create scenario inserted
+    """
+    generator = random.Random(seed)
+    with app.app_context():
+        max_id = db.session.query(db.func.max(Question.id)).scalar() or 1
+        pages = max(max_id // 10, 1)
+
+    created = []
+    lock = threading.Lock()
+
+    def record_created(data):
+        with lock:
+            created.append(data['created'])
+
+    def next_created():
+        with lock:
+            return created.pop() if created else max_id
+
+    return [
+        ('GET /categories', lambda: ('GET', '/categories', None), None),
+        ('GET /questions', lambda: ('GET', '/questions?page={}'.format(generator.randint(1, pages)), None), None),
+        ('GET /categories/<id>/questions', lambda: (
+            'GET', '/categories/{}/questions?page={}'.format(
+                generator.randint(1, len(CATEGORIES)), generator.randint(1, max(pages // 6, 1))), None), None),
+        ('POST /questions/search', lambda: (
+            'POST', '/questions/search', {'searchTerm': generator.choice(WORDS)}), None),
+        ('POST /quizzes', lambda: (
+            'POST', '/quizzes', {
+                'previous_questions': [generator.randint(1, max_id) for _ in range(5)],
+                'quiz_category': {'id': generator.randint(0, len(CATEGORIES))}}), None),
+        ('POST /questions', lambda: (
+            'POST', '/questions', {
+                'question': 'Benchmark question?', 'answer': 'Benchmark',
+                'category': generator.randint(1, len(CATEGORIES)), 'difficulty': 1}), record_created),
+        ('DELETE /questions/<id>', lambda: ('DELETE', '/questions/{}'.format(next_created()), None), None),
+    ]
+
+
+def summarize(latencies, elapsed, errors):
+    latencies = sorted(latencies)
+
+    def quantile(fraction):
+        if not latencies:
+            return None
+        index = min(int(round(fraction * (len(latencies) - 1))), len(latencies) - 1)
+        return round(1000 * latencies[index], 3)
+
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'p50_ms': quantile(0.50),
+        'p99_ms': quantile(0.99),
+        'mean_ms': round(1000 * sum(latencies) / len(latencies), 3) if latencies else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None
+    }
+
+
+def run_client(app, scenario, requests, warmup=0):
+    name, make_request, on_success = scenario
+    client = app.test_client()
+    latencies = []
+    errors = 0
+
+    # first requests build in-memory indexes and caches
+    for _ in range(warmup):
+        method, path, body = make_request()
+        response = client.open(path, method=method, json=body)
+        if on_success is not None and response.status_code == 200:
+            on_success(response.get_json())
+
+    started = time.perf_counter()
+    for _ in range(requests):
+        method, path, body = make_request()
+        request_started = time.perf_counter()
+        response = client.open(path, method=method, json=body)
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code >= 500 or response.status_code == 422:
+            errors += 1
+        elif on_success is not None and response.status_code == 200:
+            on_success(response.get_json())
+
+    return summarize(latencies, time.perf_counter() - started, errors)
+
+
+def run_http(base_url, scenario, requests, concurrency):
+    name, make_request, on_success = scenario
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+
+    def one():
+        method, path, body = make_request()
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        request = urllib.request.Request(
+            base_url + path, data=data, method=method,
+            headers={'Content-Type': 'application/json'})
+        request_started = time.perf_counter()
+        try:
+            with urllib.request.urlopen(request) as response:
+                payload = response.read()
+                ok = True
+        except urllib.error.HTTPError as e:
+            ok = e.code not in (422,) and e.code < 500
+            payload = None
+        elapsed = time.perf_counter() - request_started
+
+        with lock:
+            latencies.append(elapsed)
+            if not ok:
+                errors[0] += 1
+        if ok and payload and on_success is not None:
+            on_success(json.loads(payload))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(one) for _ in range(requests)]:
+            future.result()
+
+    return summarize(latencies, time.perf_counter() - started, errors[0])
+
+
+STARTUP_REQUESTS = (
+    ('GET /categories', 'GET', '/categories', None),
+    ('GET /questions', 'GET', '/questions', None),
+    ('POST /questions/search', 'POST', '/questions/search', {'searchTerm': 'river'}),
+    ('POST /quizzes', 'POST', '/quizzes', {'previous_questions': [], 'quiz_category': {'id': 0}}),
+)
+
+
+# the probe imports the app itself, since this module already has
+STARTUP_PROBE = """
+import json, sys, time
+started = time.perf_counter()
+from flaskr import create_app
+imported = time.perf_counter()
+from benchmark import startup_probe
+print(json.dumps(startup_probe(sys.argv[1], sys.argv[2] == 'preload', started, imported)))
+"""
+
+
+def startup_probe(database_uri, preload, started, imported):
+    """
+    startup_probe(database_uri, preload, started, imported)
+        run in a fresh interpreter: times create_app, the index preload
+        if enabled and the first request to each read endpoint
+    """
+    app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri, 'PRELOAD_INDEXES': preload})
+    created = time.perf_counter()
+    if preload:
+        app.extensions['preload'].join()
+    ready = time.perf_counter()
+
+    client = app.test_client()
+    first_requests = {}
+    for name, method, path, body in STARTUP_REQUESTS:
+        request_started = time.perf_counter()
+        client.open(path, method=method, json=body)
+        first_requests[name] = round(1000 * (time.perf_counter() - request_started), 3)
+
+    return {
+        'import_ms': round(1000 * (imported - started), 3),
+        'create_app_ms': round(1000 * (created - imported), 3),
+        'preload_ms': round(1000 * (ready - created), 3),
+        'first_request_ms': first_requests
+    }
+
+
+def measure_startup(database_uri, runs, preload):
+    probes = []
+    for _ in range(runs):
+        command = [sys.executable, '-c', STARTUP_PROBE, database_uri, 'preload' if preload else '']
+        output = subprocess.run(
+            command, check=True, stdout=subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        probes.append(json.loads(output.decode('utf-8').strip().splitlines()[-1]))
+
+    return {
+        'runs': runs,
+        'preload': preload,
+        'import_ms': statistics.median(probe['import_ms'] for probe in probes),
+        'create_app_ms': statistics.median(probe['create_app_ms'] for probe in probes),
+        'preload_ms': statistics.median(probe['preload_ms'] for probe in probes),
+        'first_request_ms': {
+            name: statistics.median(probe['first_request_ms'][name] for probe in probes)
+            for name, _, _, _ in STARTUP_REQUESTS}
+    }
+
+
+def compare(results, baseline, max_regression):
+    """
+    compare(results, baseline, max_regression)
+        prints the p99 change per endpoint and mode, and returns the
+        entries that got slower than the allowed fraction
+    """
+    regressions = []
+    for endpoint, modes in results['results'].items():
+        for mode, current in modes.items():
+            previous = baseline.get('results', {}).get(endpoint, {}).get(mode)
+            if not previous or not previous.get('p99_ms') or current['p99_ms'] is None:
+                continue
+            change = (current['p99_ms'] - previous['p99_ms']) / previous['p99_ms']
+            print('{:32} {:6} p99 {:9.3f} ms -> {:9.3f} ms ({:+.1%})'.format(
+                endpoint, mode, previous['p99_ms'], current['p99_ms'], change))
+            if change > max_regression:
+                regressions.append((endpoint, mode, change))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the trivia API.')
+    parser.add_argument('--size', type=int, default=1000, help='questions to seed (e.g. 1000, 100000, 1000000)')
+    parser.add_argument('--database-uri', default=None, help='database to seed; a temporary SQLite file by default')
+    parser.add_argument('--requests', type=int, default=200, help='requests per endpoint and mode')
+    parser.add_argument('--concurrency', type=int, default=16, help='parallel HTTP clients')
+    parser.add_argument('--seed', type=int, default=1234)
+    parser.add_argument('--warmup', type=int, default=10, help='unmeasured requests per endpoint first')
+    parser.add_argument('--skip-http', action='store_true', help='only drive the test client')
+    parser.add_argument('--output', default=None, help='write results JSON here')
+    parser.add_argument('--baseline', default=None, help='results JSON to compare p99 against')
+    parser.add_argument('--max-regression', type=float, default=0.2, help='allowed p99 slowdown, as a fraction')
+    parser.add_argument('--startup-runs', type=int, default=0, help='fresh interpreters to time startup with')
+    parser.add_argument('--preload', action='store_true', help='start those with PRELOAD_INDEXES')
+    args = parser.parse_args(argv)
+
+    workdir = None
+    database_uri = args.database_uri
+    if database_uri is None:
+        workdir = tempfile.mkdtemp(prefix='trivia-bench-')
+        database_uri = 'sqlite:///' + os.path.join(workdir, 'trivia.db')
+
+    try:
+        app = create_app({'SQLALCHEMY_DATABASE_URI': database_uri})
+
+        started = time.perf_counter()
+        seeded = seed_database(app, args.size, args.seed)
+        print('seeded {} questions in {:.1f}s'.format(seeded, time.perf_counter() - started))
+
+        results = {
+            'meta': {
+                'size': seeded,
+                'database': database_uri.split(':', 1)[0],
+                'requests': args.requests,
+                'concurrency': args.concurrency,
+                'warmup': args.warmup,
+                'python': platform.python_version(),
+                'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S')
+            },
+            'results': {}
+        }
+
+        if args.startup_runs:
+            startup = results['startup'] = measure_startup(database_uri, args.startup_runs, args.preload)
+            print('startup: import {:.1f} ms, create_app {:.1f} ms, preload {:.1f} ms'.format(
+                startup['import_ms'], startup['create_app_ms'], startup['preload_ms']))
+            for name, elapsed in startup['first_request_ms'].items():
+                print('{:32} first request {:9.3f} ms'.format(name, elapsed))
+
+        server = None
+        if not args.skip_http:
+            server = make_server(
+                '127.0.0.1', 0, app, threaded=True, request_handler=QuietRequestHandler)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+
+        try:
+            for scenario in scenarios(app, args.seed):
+                name = scenario[0]
+                modes = {'client': run_client(app, scenario, args.requests, args.warmup)}
+                if server is not None:
+                    modes['http'] = run_http(base_url, scenario, args.requests, args.concurrency)
+                results['results'][name] = modes
+                for mode, summary in modes.items():
+                    print('{:32} {:6} p50 {:9.3f} ms  p99 {:9.3f} ms  {:8.1f} req/s  {} errors'.format(
+                        name, mode, summary['p50_ms'], summary['p99_ms'],
+                        summary['throughput_rps'], summary['errors']))
+        finally:
+            if server is not None:
+                server.shutdown()
+
+        if args.output:
+            with open(args.output, 'w') as output:
+                json.dump(results, output, indent=2, sort_keys=True)
+
+        if args.baseline:
+            with open(args.baseline) as baseline:
+                regressions = compare(results, json.load(baseline), args.max_regression)
+            if regressions:
+                print('{} p99 regressions above {:.0%}'.format(len(regressions), args.max_regression))
+                return 1
+
+        return 0
+
+    finally:
+        if workdir is not None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,156 @@
+import csv
+import io
+import json
+
+from sqlalchemy import func
+from sqlalchemy.exc import SQLAlchemyError
+
+from models import db, Question, bump_version, record_question_changes
+
+REQUIRED_FIELDS = ('question', 'answer', 'category', 'difficulty')
+
+
+def read_rows(stream, content_type):
+    """
+    read_rows(stream, content_type)
+        yields (line number, dict) for every record of an NDJSON or
+        CSV body, reading the request stream one line at a time
+    """
+    text = io.TextIOWrapper(stream, encoding='utf-8', newline='')
+
+    if content_type == 'text/csv':
+        reader = csv.DictReader(text)
+        for row in reader:
+            yield reader.line_num, row
+        return
+
+    for line_number, line in enumerate(text, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError:
+            row = None
+        yield line_number, row
+
+
+def validate_row(row):
+    """
+    validate_row(row)
+        applies the create_question checks to one imported record.
+        returns the insertable values, or raises ValueError
+    """
+    if not isinstance(row, dict):
+        raise ValueError("Row is not an object")
+
+    missing = [field for field in REQUIRED_FIELDS if row.get(field) in (None, '')]
+    if missing:
+        raise ValueError("Missing {}".format(", ".join(missing)))
+
+    return {
+        'question': row['question'],
+        'answer': row['answer'],
+        'category': int(row['category']),
+        'difficulty': int(row['difficulty'])
+    }
+
+
+def insert_chunk(values):
+    table = Question.__table__
+    insert = table.insert().values(values)
+    if db.session.get_bind(Question.__mapper__).dialect.name == 'postgresql':
+        rows = db.session.execute(insert.returning(*(table.c[field] for field in Question.FIELDS)))
+    else:
+        # SQLite serialises writers, so the new rows are those above the old maximum
+        first_id = (db.session.query(func.max(Question.id)).scalar() or 0) + 1
+        db.session.execute(insert)
+        rows = db.session.query(*Question.columns()).filter(Question.id >= first_id).all()
+    version = bump_version(Question.__tablename__)
+    record_question_changes('insert', [Question.format_row(row) for row in rows], version)
+    db.session.commit()
+
+
+def flush_chunk(chunk, errors):
+    """
+    flush_chunk(chunk, errors)
+        inserts a chunk of (line number, values) and returns how many
+        rows went in. a chunk the database rejects is rolled back and
+        reported with its first and last line, so the client can fix
+        and resend just those lines
+    """
+    try:
+        insert_chunk([values for _, values in chunk])
+    except SQLAlchemyError as e:
+        print(e)
+        db.session.rollback()
+        errors.append({
+            "line": chunk[0][0],
+            "last_line": chunk[-1][0],
+            "message": "Chunk not inserted: {}".format(str(getattr(e, 'orig', e)).strip())
+        })
+        return 0
+    return len(chunk)
+
+
+def import_questions(rows, chunk_size):
+    """
+    import_questions(rows, chunk_size)
+        inserts valid rows with one multi-row INSERT and one
+        transaction per chunk. the rows go to the change log, which
+        in-memory indexes replay on their next use. earlier chunks stay
+        committed when a later one fails or the body can't be read
+        further, so both are reported in errors rather than raised
+    """
+    inserted = 0
+    errors = []
+    chunk = []
+    line_number = 0
+    rows = iter(rows)
+
+    while True:
+        try:
+            line_number, row = next(rows)
+        except StopIteration:
+            break
+        except (UnicodeDecodeError, csv.Error) as e:
+            errors.append({"line": line_number + 1, "message": "Unreadable body: {}".format(e)})
+            break
+
+        try:
+            chunk.append((line_number, validate_row(row)))
+        except (ValueError, TypeError) as e:
+            errors.append({"line": line_number, "message": str(e)})
+            continue
+
+        if len(chunk) >= chunk_size:
+            inserted += flush_chunk(chunk, errors)
+            chunk = []
+
+    if chunk:
+        inserted += flush_chunk(chunk, errors)
+
+    return inserted, errors
+
+
+def export_questions(export_format, batch_size):
+    """
+    export_questions(export_format, batch_size)
+        yields every question as NDJSON lines or CSV rows, fetching
+        plain column tuples through a server-side cursor
+    """
+    rows = db.session.query(*Question.columns()).order_by(Question.id).yield_per(batch_size)
+
+    if export_format == 'csv':
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(Question.FIELDS)
+        for row in rows:
+            writer.writerow(row)
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+        yield buffer.getvalue()
+        return
+
+    for row in rows:
+        yield json.dumps(dict(zip(Question.FIELDS, row))) + "\n"
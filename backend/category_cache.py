@@ -0,0 +1,58 @@
+import hashlib
+import json
+import threading
+import time
+
+from flask import current_app
+
+from models import Category
+
+"""
+CategoryCache
+    process-wide {id: type} map of categories with a TTL.
+    categories almost never change, so the table is read at most
+    once per TTL (or after invalidate()) instead of on every request
+"""
+class CategoryCache:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.categories = None
+        self.etag = None
+        self.loaded_at = 0
+
+    def load(self):
+        categories = {
+            category.id: category.type
+            for category in Category.query.order_by(Category.id).all()}
+        digest = hashlib.sha1(
+            json.dumps(categories, sort_keys=True).encode("utf-8")).hexdigest()
+
+        with self.lock:
+            self.categories = categories
+            self.etag = digest[:16]
+            self.loaded_at = time.monotonic()
+
+    def get(self):
+        if self.categories is None or time.monotonic() - self.loaded_at > self.ttl:
+            self.load()
+        return self.categories
+
+    def invalidate(self):
+        with self.lock:
+            self.categories = None
+            self.etag = None
+
+
+def setup_category_cache(app):
+    app.extensions['category_cache'] = CategoryCache(
+        app.config.get('CATEGORY_CACHE_TTL', 300))
+
+
+def category_cache():
+    return current_app.extensions['category_cache']
+
+
+def invalidate_categories():
+    category_cache().invalidate()
@@ -0,0 +1,48 @@
+import gzip
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESSIBLE_MIMETYPES = ("application/json", "application/x-ndjson", "text/csv", "text/plain")
+
+"""
+compress_response(response, accept_encoding, min_size, level)
+    brotli- or gzip-encodes a finished response body in place when the
+    client accepts it and the body is at least min_size bytes.
+    brotli is used only when the optional brotli package is installed
+"""
+def compress_response(response, accept_encoding, min_size=500, level=6):
+    if (response.status_code < 200 or response.status_code >= 300
+            or response.direct_passthrough or response.is_streamed
+            or "Content-Encoding" in response.headers
+            or response.mimetype not in COMPRESSIBLE_MIMETYPES):
+        return response
+
+    response.vary.add("Accept-Encoding")
+
+    body = response.get_data()
+    if len(body) < min_size:
+        return response
+
+    accepted = [encoding.split(";")[0].strip() for encoding in accept_encoding.split(",")]
+    if brotli is not None and "br" in accepted:
+        encoding = "br"
+        body = brotli.compress(body, quality=min(level, 11))
+    elif "gzip" in accepted:
+        encoding = "gzip"
+        body = gzip.compress(body, compresslevel=level)
+    else:
+        return response
+
+    response.set_data(body)
+    response.headers["Content-Encoding"] = encoding
+
+    # the encoded bytes differ from the identity ones, so a strong
+    # validator no longer holds byte-for-byte
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        response.set_etag(etag, weak=True)
+
+    return response
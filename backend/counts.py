@@ -0,0 +1,73 @@
+from sqlalchemy import func
+
+from models import db, Question
+from indexes import QuestionIndex, register_index, get_index, read_version
+
+"""
+QuestionCounts
+    total and per-category question counts held in memory.
+    seeded with one COUNT(*) ... GROUP BY category and kept current
+    by Question.insert()/delete(). questions without a category, e.g.
+    after their category was deleted (ON DELETE SET NULL), are counted
+    in uncategorized, so total() still equals COUNT(*)
+"""
+class QuestionCounts(QuestionIndex):
+
+    def __init__(self):
+        super().__init__()
+        self.by_category = {}
+        self.uncategorized = 0
+        self.max_id = 0
+
+    def load(self):
+        rows = db.session.query(
+            Question.category, func.count(Question.id)
+        ).group_by(Question.category).all()
+
+        self.by_category = {
+            int(category): count for category, count in rows
+            if category is not None}
+        self.uncategorized = sum(count for category, count in rows if category is None)
+        self.max_id = db.session.query(func.max(Question.id)).scalar() or 0
+
+    def apply(self, event, question):
+        if event == 'update':
+            # the previous category is unknown, recount
+            return False
+        if event == 'delete' and question['id'] == self.max_id:
+            return False
+        self.max_id = max(self.max_id, question['id'])
+        step = 1 if event == 'insert' else -1
+        if question['category'] is None:
+            self.uncategorized += step
+            return
+
+        category = int(question['category'])
+        self.by_category[category] = self.by_category.get(category, 0) + step
+
+    def total(self):
+        return sum(self.by_category.values()) + self.uncategorized
+
+    def for_category(self, category_id):
+        return self.by_category.get(int(category_id), 0)
+
+
+def setup_counts(app):
+    register_index(app, 'counts', QuestionCounts())
+
+
+def question_counts():
+    return get_index('counts')
+
+
+def lagging_read():
+    """
+    lagging_read()
+        True when this request reads from a replica that is behind the
+        version this worker's counts already reflect, e.g. right after
+        its own write. pages read then are older than the stamp that
+        cache keys and ETags are built from, so they get neither. also
+        True while the counts' own version is unknown
+    """
+    version = question_counts().version
+    return version is None or read_version() < version
@@ -1,35 +1,208 @@
 import os
-from flask import Flask, request, abort, jsonify
+import base64
+import hashlib
+from flask import Flask, Response, current_app, request, abort, stream_with_context
 from flask_sqlalchemy import SQLAlchemy
 from flask_cors import CORS
-import random
 
-from models import setup_db, Question, Category
+from models import setup_db, db, Question, Category
+from indexes import preload_indexes
+from counts import setup_counts, question_counts, lagging_read
+from category_cache import setup_category_cache, category_cache
+from search import setup_search, cached_search, suggestions
+from quiz import setup_quiz, quiz_sampler, quiz_sessions, start_session, next_difficulty, sample_adaptive
+from bulk import read_rows, import_questions, export_questions
+from migrations import upgrade_command, check_schema
+from pool import pool_status
+from metrics import setup_metrics, start_request, finish_request
+from serialization import setup_serialization, json_response
+from compression import compress_response
+from response_cache import setup_response_cache, cached, render_cache_metrics
+from replicas import setup_replicas, reads_from_replica, replica_status
 
 QUESTIONS_PER_PAGE = 10
+MAX_QUESTIONS_PER_PAGE = 500
+MAX_SUGGESTIONS = 50
+MAX_QUIZ_QUESTIONS = 50
 
 
-def paginate_questions(request, selection):
-    page = request.args.get("page", 1, type=int)
-    start = (page - 1) * QUESTIONS_PER_PAGE
-    end = start + QUESTIONS_PER_PAGE
+def encode_cursor(question_id):
+    """
+    encode_cursor(question_id)
+        wraps the last id of a page into an opaque keyset cursor
+    """
+    raw = str(question_id).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor):
+    """
+    decode_cursor(cursor)
+        turns an opaque keyset cursor back into the last id already seen
+    """
+    padded = cursor + "=" * (-len(cursor) % 4)
+    return int(base64.urlsafe_b64decode(padded.encode("ascii")))
+
+
+def page_size(request):
+    """
+    page_size(request)
+        ?per_page= clamped to 1..MAX_QUESTIONS_PER_PAGE (configurable),
+        QUESTIONS_PER_PAGE when absent
+    """
+    per_page = request.args.get("per_page", QUESTIONS_PER_PAGE, type=int)
+    limit = current_app.config.get("MAX_QUESTIONS_PER_PAGE", MAX_QUESTIONS_PER_PAGE)
+    return min(max(per_page, 1), limit)
+
+
+def question_fields(request):
+    """
+    question_fields(request)
+        the Question fields named in ?fields=, in column order.
+        id is always included since cursors are built from it
+    """
+    fields = request.args.get("fields", None)
+    if fields is None:
+        return Question.FIELDS
+
+    requested = set(field.strip() for field in fields.split(",") if field.strip())
+    if not requested.issubset(Question.FIELDS):
+        abort(400)
+
+    return tuple(field for field in Question.FIELDS if field == "id" or field in requested)
+
+
+def page_cursor(request):
+    """
+    page_cursor(request)
+        the last id already seen, decoded from ?after_id=, or None.
+        aborts with 400 when the cursor can't be decoded
+    """
+    after_id = request.args.get("after_id", None)
+    if after_id is None:
+        return None
+
+    try:
+        return decode_cursor(after_id)
+    except ValueError:
+        abort(400)
 
-    questions = [question.format() for question in selection]
-    current_questions = questions[start:end]
 
-    return current_questions
+def listing_arguments(request):
+    """
+    listing_arguments(request)
+        (per_page, fields, after_id) of a listing request. views call it
+        before their try block, so a bad ?fields= or ?after_id= is
+        answered with 400 rather than caught and turned into 422
+    """
+    return page_size(request), question_fields(request), page_cursor(request)
+
+
+def paginate_questions(request, selection, arguments=None):
+    """
+    paginate_questions(request, selection, arguments=None)
+        pages a Question query in the database with LIMIT/OFFSET,
+        or with a keyset cursor when ?after_id= is given, selecting
+        only the columns named in ?fields=. arguments are the
+        listing_arguments(request), read here when not given.
+        returns the formatted page and the cursor for the next one
+    """
+    per_page, fields, after_id = arguments or listing_arguments(request)
+    selection = selection.with_entities(*Question.columns(fields))
+
+    if after_id is not None:
+        selection = selection.order_by(None).filter(
+            Question.id > after_id
+        ).order_by(Question.id)
+        page_rows = selection.limit(per_page + 1).all()
+    else:
+        page = request.args.get("page", 1, type=int)
+        start = (page - 1) * per_page
+        page_rows = selection.offset(start).limit(
+            per_page + 1).all() if page > 0 else []
+
+    next_cursor = None
+    if len(page_rows) > per_page:
+        page_rows = page_rows[:per_page]
+        next_cursor = encode_cursor(page_rows[-1].id)
+
+    current_questions = [Question.format_row(row, fields) for row in page_rows]
+
+    return current_questions, next_cursor
+
+
+def listing_etag(request):
+    """
+    listing_etag(request)
+        weak validator for a question listing, derived from the questions
+        version stamp, row count and max id plus the category map, so it
+        can be checked without running the page query. None when the
+        page is read from a lagging replica
+    """
+    if lagging_read():
+        return None
+
+    counts = question_counts()
+    cache = category_cache()
+    cache.get()
+    key = "{}:{}:{}:{}:{}".format(
+        counts.version, counts.total(), counts.max_id, cache.etag,
+        request.full_path)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:20]
+
+
+def not_modified(etag):
+    response = current_app.response_class(status=304)
+    response.set_etag(etag, weak=True)
+    return response
+
+
+def include_page(request, payload):
+    """
+    include_page(request, payload)
+        adds the first page of the question listing to a mutation
+        response, only when the client asks for it with ?include=page
+    """
+    if "page" in request.args.get("include", "").split(","):
+        payload["questions"], payload["next_cursor"] = paginate_questions(
+            request, Question.query.order_by(Question.id))
+
+    return payload
 
 
 def create_app(test_config=None):
     # create and configure the app
     app = Flask(__name__)
 
+    if test_config is not None:
+        app.config.from_mapping(test_config)
+
     if test_config is None:
         setup_db(app)
     else:
         database_path = test_config.get('SQLALCHEMY_DATABASE_URI')
         setup_db(app, database_path=database_path)
 
+    app.cli.add_command(upgrade_command)
+
+    setup_replicas(app)
+
+    setup_counts(app)
+    setup_category_cache(app)
+    setup_search(app)
+    setup_quiz(app)
+    setup_metrics(app)
+    setup_serialization(app)
+    setup_response_cache(app)
+
+    # the schema is checked on the first request, not at startup,
+    # and not at all in production where migrations run on deploy
+    if app.config.get("SCHEMA_CHECK", app.config["ENV"] != "production"):
+        app.before_first_request(check_schema)
+
+    if app.config.get("PRELOAD_INDEXES", False):
+        app.extensions["preload"] = preload_indexes(app)
+
     """
     TO/DO: Set up CORS. Allow '*' for origins. Delete the sample route after completing the TODOs
     """
@@ -37,6 +210,10 @@ def create_app(test_config=None):
     """
     TO/DO: Use the after_request decorator to set Access-Control-Allow
     """
+    @app.before_request
+    def before_request():
+        start_request()
+
     @app.after_request
     def after_request(response):
         response.headers.add(
@@ -45,7 +222,18 @@ def create_app(test_config=None):
         response.headers.add(
             "Access-Control-Allow-Methods", "GET,PUT,POST,DELETE,OPTIONS"
         )
-        return response
+        response = compress_response(
+            response, request.headers.get("Accept-Encoding", ""),
+            app.config.get("COMPRESS_MIN_SIZE", 500),
+            app.config.get("COMPRESS_LEVEL", 6))
+        return finish_request(app.extensions['metrics'], response)
+
+    @app.route("/metrics", methods=["GET"])
+    def metrics():
+        return app.response_class(
+            app.extensions['metrics'].render() + render_cache_metrics(),
+            mimetype="text/plain; version=0.0.4"
+        )
 
     """
     Create an endpoint to handle GET requests 
@@ -93,20 +281,38 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories", methods=["GET"])
+    @reads_from_replica
+    @cached
     def retrieve_categories():
-        categories = Category.query.all()
-        string_categories = {
-            category.id: category.type for category in categories}
+        cache = category_cache()
+        string_categories = cache.get()
 
-        if not categories:
+        if not string_categories:
             abort(404)
 
-        return jsonify(
-            {
-                "success": True,
-                "categories": string_categories
-            }
-        )
+        counts = question_counts()
+        # no validator while the counts' version is unknown
+        etag = None
+        if counts.version is not None:
+            etag = "{}-{}".format(cache.etag, counts.version)
+
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+        else:
+            response = json_response(
+                {
+                    "success": True,
+                    "categories": string_categories,
+                    "question_counts": {
+                        category_id: counts.for_category(category_id)
+                        for category_id in string_categories}
+                }
+            )
+
+        if etag is not None:
+            response.set_etag(etag)
+        response.headers["Cache-Control"] = "public, no-cache"
+        return response
 
     """
     TO/DO:
@@ -122,19 +328,26 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions", methods=["GET"])
+    @reads_from_replica
+    @cached
     def retrieve_questions():
         current_category = request.args.get("currentCategory", None)
 
+        etag = listing_etag(request)
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        arguments = listing_arguments(request)
+
         try:
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            selection = Question.query.order_by(Question.id)
+            current_questions, next_cursor = paginate_questions(
+                request, selection, arguments)
 
-            categories = Category.query.all()
-            string_categories = {
-                category.id: category.type for category in categories}
+            string_categories = category_cache().get()
 
             if len(current_questions) == 0:
-                return jsonify(
+                return json_response(
                     {
                         "success": False,
                         "error": 404,
@@ -144,16 +357,20 @@ def create_app(test_config=None):
                     }
                 ), 404
 
-            return jsonify(
+            response = json_response(
                 {
                     "success": True,
                     "questions": current_questions,
-                    "total_questions": len(Question.query.all()),
+                    "total_questions": question_counts().total(),
+                    "next_cursor": next_cursor,
                     "categories": string_categories,
                     # "current_category": current_category["id"]  # FIXME check this
                     "current_category": current_category if current_category else None
                 }
             )
+            if etag is not None:
+                response.set_etag(etag, weak=True)
+            return response
 
         except Exception as e:
             print(e)
@@ -181,15 +398,60 @@ def create_app(test_config=None):
                 abort(404)
 
             question.delete()
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
 
-            return jsonify(
+            return json_response(include_page(request, {
+                "success": True,
+                "deleted": question_id,
+                "total_questions": question_counts().total(),
+            }))
+
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    """
+    Delete many questions at once, by a list of ids and/or a filter
+    on category and difficulty range.
+    """
+
+    @app.route("/questions", methods=["DELETE"])
+    @app.route("/questions/delete", methods=["POST"])
+    def delete_questions():
+        body = request.get_json()
+
+        if body is None:
+            abort(400)
+
+        criteria = []
+        try:
+            if body.get("ids", None) is not None:
+                question_ids = body["ids"]
+                if not isinstance(question_ids, list) or not all(
+                        type(question_id) is int for question_id in question_ids):
+                    abort(422)
+                criteria.append(Question.id.in_(question_ids))
+            if body.get("category", None) is not None:
+                criteria.append(Question.category == int(body["category"]))
+            if body.get("min_difficulty", None) is not None:
+                criteria.append(Question.difficulty >= int(body["min_difficulty"]))
+            if body.get("max_difficulty", None) is not None:
+                criteria.append(Question.difficulty <= int(body["max_difficulty"]))
+        except (TypeError, ValueError):
+            abort(422)
+
+        if not criteria:
+            abort(422)
+
+        try:
+            deleted = Question.delete_where(*criteria)
+            counts = question_counts()
+
+            return json_response(
                 {
                     "success": True,
-                    "deleted": question_id,
-                    "questions": current_questions,
-                    "total_questions": len(Question.query.all()),
+                    "deleted": deleted,
+                    "total_questions": counts.total(),
+                    "question_counts": counts.by_category
                 }
             )
 
@@ -232,15 +494,39 @@ def create_app(test_config=None):
             )
             question.insert()
 
-            selection = Question.query.order_by(Question.id).all()
-            current_questions = paginate_questions(request, selection)
+            return json_response(include_page(request, {
+                "success": True,
+                "created": question.id,
+                "total_questions": question_counts().total(),
+            }))
 
-            return jsonify(
+        except Exception as e:
+            print(e)
+            abort(422)
+
+    """
+    Bulk import and export of questions as NDJSON (one question object
+    per line) or CSV with a header row.
+    """
+
+    @app.route("/questions/bulk", methods=["POST"])
+    def bulk_create_questions():
+        content_type = request.mimetype
+
+        if content_type not in ("application/x-ndjson", "text/csv"):
+            abort(400)
+
+        try:
+            inserted, errors = import_questions(
+                read_rows(request.stream, content_type),
+                app.config.get("BULK_CHUNK_SIZE", 1000))
+
+            return json_response(
                 {
                     "success": True,
-                    "created": question.id,
-                    "questions": current_questions,
-                    "total_questions": len(Question.query.all()),
+                    "inserted": inserted,
+                    "errors": errors,
+                    "total_questions": question_counts().total(),
                 }
             )
 
@@ -248,6 +534,20 @@ def create_app(test_config=None):
             print(e)
             abort(422)
 
+    @app.route("/questions/export", methods=["GET"])
+    @reads_from_replica
+    def export_all_questions():
+        export_format = request.args.get("format", "ndjson")
+
+        if export_format not in ("ndjson", "csv"):
+            abort(400)
+
+        return Response(
+            stream_with_context(export_questions(
+                export_format, app.config.get("BULK_CHUNK_SIZE", 1000))),
+            mimetype="text/csv" if export_format == "csv" else "application/x-ndjson"
+        )
+
     """
     TO/DO:
     Create a POST endpoint to get questions based on a search term.
@@ -260,6 +560,7 @@ def create_app(test_config=None):
     """
 
     @app.route("/questions/search", methods=["POST"])
+    @reads_from_replica
     def search_questions():
         body = request.get_json()
 
@@ -271,25 +572,24 @@ def create_app(test_config=None):
         if search_term is None:
             abort(422)
 
-        search = "%{}%".format(search_term)
+        page = request.args.get("page", 1, type=int)
+        per_page = page_size(request)
+        fields = question_fields(request)
+        start = (page - 1) * per_page
 
         try:
-            selection = Question.query.filter(
-                Question.question.ilike(search)).all()
-            current_questions = paginate_questions(request, selection)
+            selection, total_questions = cached_search(
+                search_term, start, per_page, fields) if page > 0 else ([], 0)
+            current_questions = [Question.format_row(row, fields) for row in selection]
 
             if len(current_questions) == 0:
                 abort(404)
 
-            categories = Category.query.all()
-            string_categories = {
-                category.id: category.type for category in categories}
-
-            return jsonify(
+            return json_response(
                 {
                     "success": True,
                     "questions": current_questions,
-                    "total_questions": len(selection)
+                    "total_questions": total_questions
                 }
             )
 
@@ -297,6 +597,23 @@ def create_app(test_config=None):
             print(e)
             abort(422)
 
+    @app.route("/questions/suggest", methods=["GET"])
+    @reads_from_replica
+    def suggest_questions():
+        text = request.args.get("q", None)
+
+        if text is None:
+            abort(422)
+
+        limit = min(max(request.args.get("limit", 10, type=int), 1), MAX_SUGGESTIONS)
+
+        return json_response(
+            {
+                "success": True,
+                "suggestions": suggestions().suggest(text, limit)
+            }
+        )
+
     """
     TO/DO:
     Create a GET endpoint to get questions based on category.
@@ -307,27 +624,39 @@ def create_app(test_config=None):
     """
 
     @app.route("/categories/<int:category_id>/questions", methods=["GET"])
+    @reads_from_replica
+    @cached
     def retrieve_questions_in_category(category_id):
+        etag = listing_etag(request)
+        if etag is not None and request.if_none_match.contains_weak(etag):
+            return not_modified(etag)
+
+        arguments = listing_arguments(request)
+
         try:
-            category = Category.query.filter(
-                Category.id == category_id).one_or_none()
+            category_type = category_cache().get().get(category_id)
 
-            if category is None:
+            if category_type is None:
                 abort(404)
 
             selection = Question.query.filter(
-                Question.category == category_id).all()
+                Question.category == category_id).order_by(Question.id)
 
-            current_questions = paginate_questions(request, selection)
+            current_questions, next_cursor = paginate_questions(
+                request, selection, arguments)
 
-            return jsonify(
+            response = json_response(
                 {
                     "success": True,
                     "questions": current_questions,
-                    "total_questions": len(selection),
-                    "current_category": category.type
+                    "total_questions": question_counts().for_category(category_id),
+                    "next_cursor": next_cursor,
+                    "current_category": category_type
                 }
             )
+            if etag is not None:
+                response.set_etag(etag, weak=True)
+            return response
 
         except Exception as e:
             print(e)
@@ -346,6 +675,7 @@ def create_app(test_config=None):
     """
 
     @app.route("/quizzes", methods=["POST"])
+    @reads_from_replica
     def play_quiz():
         try:
             body = request.get_json()
@@ -359,30 +689,129 @@ def create_app(test_config=None):
             if previous_questions is None or quiz_category is None:
                 abort(422)
 
-            if quiz_category["id"] == 0:
-                selection = Question.query.all()
+            count = body.get("count", None)
+            if count is not None and (type(count) is not int or count < 1):
+                abort(422)
+            limit = min(count or 1, MAX_QUIZ_QUESTIONS)
+
+            payload = {"success": True}
+
+            if body.get("adaptive", False):
+                recent_answers = body.get("recent_answers", [])
+                if not all(isinstance(correct, bool) for correct in recent_answers):
+                    abort(422)
+                question_ids, payload["difficulty"] = sample_adaptive(
+                    quiz_sampler(), quiz_category["id"], previous_questions,
+                    next_difficulty(recent_answers), limit)
             else:
-                selection = Question.query.filter(
-                    Question.category == quiz_category["id"],
-                    Question.id.notin_(previous_questions)
-                ).all()
+                question_ids = quiz_sampler().sample(
+                    quiz_category["id"], previous_questions, count=limit)
 
-            if len(selection) == 0:
+            if not question_ids:
                 abort(404)
 
-            question = random.choice(selection)
+            # one query for the whole batch, returned in the order drawn
+            rows = {
+                row.id: row
+                for row in db.session.query(*Question.columns()).filter(
+                    Question.id.in_(question_ids)).all()}
+            questions = [
+                Question.format_row(rows[question_id])
+                for question_id in question_ids if question_id in rows]
 
-            return jsonify(
-                {
-                    "success": True,
-                    "question": question.format()
-                }
-            )
+            payload["question"] = questions[0]
+            if count is not None:
+                payload["questions"] = questions
+
+            return json_response(payload)
 
         except Exception as e:
             print(e)
             abort(422)
 
+    """
+    Quiz sessions keep the unplayed question ids on the server,
+    so clients don't resend previous_questions on every step.
+    """
+
+    @app.route("/quizzes/sessions", methods=["POST"])
+    @reads_from_replica
+    def create_quiz_session():
+        body = request.get_json()
+
+        if body is None:
+            abort(400)
+
+        quiz_category = body.get("quiz_category", None)
+        previous_questions = body.get("previous_questions", None) or []
+
+        if (not isinstance(quiz_category, dict) or quiz_category.get("id", None) is None
+                or not isinstance(previous_questions, list)):
+            abort(422)
+
+        try:
+            session = start_session(quiz_category["id"], previous_questions)
+            session_id = quiz_sessions().create(session)
+        except Exception as e:
+            print(e)
+            abort(422)
+
+        if session.remaining() == 0:
+            abort(404)
+
+        return json_response(
+            {
+                "success": True,
+                "session_id": session_id,
+                "total_questions": session.remaining()
+            }
+        )
+
+    @app.route("/quizzes/sessions/<session_id>/next", methods=["POST"])
+    @reads_from_replica
+    def next_quiz_question(session_id):
+        session = quiz_sessions().get(session_id)
+
+        if session is None:
+            abort(404)
+
+        question = None
+        while question is None:
+            question_id = session.next()
+            if question_id is None:
+                abort(404)
+            # ids deleted since the session started are skipped
+            question = db.session.query(*Question.columns()).filter(
+                Question.id == question_id).first()
+        quiz_sessions().save(session_id, session)
+
+        return json_response(
+            {
+                "success": True,
+                "question": Question.format_row(question),
+                "remaining": session.remaining()
+            }
+        )
+
+    @app.route("/health", methods=["GET"])
+    def health():
+        try:
+            db.session.execute("SELECT 1")
+            database = "ok"
+        except Exception as e:
+            print(e)
+            db.session.rollback()
+            database = "unavailable"
+
+        return json_response(
+            {
+                "success": database == "ok",
+                "database": database,
+                "pool": pool_status(db.engine.pool),
+                "replicas": replica_status()
+            }
+        ), 200 if database == "ok" else 503
+
     """
     TO/DO:
     Create error handlers for all expected errors
@@ -390,7 +819,7 @@ def create_app(test_config=None):
     """
     @app.errorhandler(400)
     def bad_request(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 400,
             "message": "Bad request"
@@ -398,7 +827,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(404)
     def not_found(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 404,
             "message": "Not found"
@@ -406,7 +835,7 @@ def create_app(test_config=None):
 
     @app.errorhandler(422)
     def unprocessable(error):
-        return jsonify({
+        return json_response({
             "success": False,
             "error": 422,
             "message": "Unprocessable"
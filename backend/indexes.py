@@ -0,0 +1,157 @@
+import threading
+
+from flask import current_app, g, has_request_context
+
+from models import Question, current_version, question_changes, question_listeners
+
+# changes replayed from the log before a stale index reloads instead
+CHANGE_LOG_LIMIT = 5000
+# loads tried while other workers' writes keep moving the stamp
+LOAD_ATTEMPTS = 3
+
+"""
+QuestionIndex
+    base for in-memory structures derived from the questions table.
+    subclasses implement load() to build from the database and
+    apply(event, question) to fold in a single committed write.
+    the structure remembers the 'questions' version stamp it matches;
+    when another worker writes, the stamp moves on and the next
+    refresh() replays the question_changes logged since through
+    apply(). it rebuilds from the database only when more than
+    CHANGE_LOG_LIMIT changes are pending, the log was pruned past its
+    version, or apply() returns False
+"""
+class QuestionIndex:
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.version = None
+
+    def load(self):
+        raise NotImplementedError
+
+    def apply(self, event, question):
+        raise NotImplementedError
+
+    def rebuild(self):
+        version = read_version()
+        with self.lock:
+            if self.is_current(version):
+                # another thread built it while this one waited
+                return
+            self.version = self.load_at(version)
+
+    def load_at(self, version):
+        """
+        load()s until no write commits during the load, so the result
+        matches the stamp read before it and no logged change is later
+        replayed onto a load that already has it. returns that stamp,
+        or None when it kept moving
+        """
+        for _ in range(LOAD_ATTEMPTS):
+            self.load()
+            loaded = current_version(Question.__tablename__)
+            if loaded == version:
+                return version
+            version = loaded
+        return None
+
+    def is_current(self, version):
+        return self.version is not None and self.version >= version
+
+    def refresh(self):
+        # stamps only grow, so a lagging read replica reporting an older
+        # one than this structure already reflects doesn't force a rebuild
+        version = read_version()
+        if not self.is_current(version) and not self.catch_up(version):
+            self.rebuild()
+        return self
+
+    def catch_up(self, version):
+        """
+        applies the logged changes up to version, read through the same
+        connection as the stamp. False when a rebuild is needed instead
+        """
+        with self.lock:
+            if self.is_current(version):
+                return True
+            if self.version is None or version - self.version > CHANGE_LOG_LIMIT:
+                return False
+
+            changes = question_changes(self.version, version, CHANGE_LOG_LIMIT)
+            if changes is None:
+                return False
+            for _, event, question in changes:
+                if self.apply(event, question) is False:
+                    self.version = None
+                    return False
+            self.version = version
+            return True
+
+    def invalidate(self):
+        with self.lock:
+            self.version = None
+
+    def on_change(self, event, question, version):
+        with self.lock:
+            if self.version is None or version != self.version + 1:
+                # another worker wrote in between; the next refresh()
+                # replays its changes and this one from the log
+                return
+
+            if self.apply(event, question) is False:
+                self.version = None
+            else:
+                self.version = version
+
+
+def read_version():
+    """
+    read_version()
+        the questions version stamp seen by this request's database
+        connection (its replica, when the view reads from one). read
+        once per request and forgotten when the request writes
+    """
+    if not has_request_context():
+        return current_version(Question.__tablename__)
+    if "questions_version" not in g:
+        g.questions_version = current_version(Question.__tablename__)
+    return g.questions_version
+
+
+def register_index(app, name, index):
+    app.extensions.setdefault('question_indexes', {})[name] = index
+    return index
+
+
+def preload_indexes(app):
+    """
+    preload_indexes(app)
+        builds every registered index on a background thread, so the
+        worker accepts requests at once and its first requests find the
+        indexes built, or wait for the build already under way
+    """
+    def build():
+        with app.app_context():
+            for index in app.extensions.get('question_indexes', {}).values():
+                try:
+                    index.refresh()
+                except Exception as e:
+                    print(e)
+
+    thread = threading.Thread(target=build, name="trivia-preload", daemon=True)
+    thread.start()
+    return thread
+
+
+def get_index(name):
+    return current_app.extensions['question_indexes'][name].refresh()
+
+
+def _on_question_change(event, question, version):
+    indexes = current_app.extensions.get('question_indexes', {})
+    for index in indexes.values():
+        index.on_change(event, question, version)
+
+
+question_listeners.append(_on_question_change)
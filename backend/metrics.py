@@ -0,0 +1,172 @@
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from models import db
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+"""
+Histogram
+    cumulative-bucket histogram in the Prometheus exposition format
+"""
+class Histogram:
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def lines(self, name, labels):
+        cumulative = 0
+        for bound, count in zip(self.buckets + ("+Inf",), self.counts):
+            cumulative += count
+            yield '{}_bucket{{{},le="{}"}} {}'.format(name, labels, bound, cumulative)
+        yield '{}_sum{{{}}} {}'.format(name, labels, self.sum)
+        yield '{}_count{{{}}} {}'.format(name, labels, self.count)
+
+
+"""
+RouteMetrics
+    per route and method: request latency and SQL statements per
+    request as histograms, plus totals for DB time, ORM rows hydrated,
+    response bytes and responses by status
+"""
+class RouteMetrics:
+
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.statements = Histogram(STATEMENT_BUCKETS)
+        self.db_seconds = 0.0
+        self.rows_hydrated = 0
+        self.response_bytes = 0
+        self.responses = {}
+
+
+"""
+MetricsRegistry
+    all RouteMetrics of one app, rendered at /metrics
+"""
+class MetricsRegistry:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.routes = {}
+
+    def record(self, route, method, status, seconds, statements, db_seconds, rows, size):
+        with self.lock:
+            metrics = self.routes.setdefault((route, method), RouteMetrics())
+            metrics.latency.observe(seconds)
+            metrics.statements.observe(statements)
+            metrics.db_seconds += db_seconds
+            metrics.rows_hydrated += rows
+            metrics.response_bytes += size
+            metrics.responses[status] = metrics.responses.get(status, 0) + 1
+
+    def render(self):
+        lines = []
+        with self.lock:
+            routes = [
+                ('route="{}",method="{}"'.format(route, method), metrics)
+                for (route, method), metrics in sorted(self.routes.items())]
+
+            lines.append("# TYPE trivia_request_duration_seconds histogram")
+            for labels, metrics in routes:
+                lines.extend(metrics.latency.lines("trivia_request_duration_seconds", labels))
+
+            lines.append("# TYPE trivia_request_statements histogram")
+            for labels, metrics in routes:
+                lines.extend(metrics.statements.lines("trivia_request_statements", labels))
+
+            for name, attribute in (
+                    ("trivia_db_seconds_total", "db_seconds"),
+                    ("trivia_rows_hydrated_total", "rows_hydrated"),
+                    ("trivia_response_bytes_total", "response_bytes")):
+                lines.append("# TYPE {} counter".format(name))
+                for labels, metrics in routes:
+                    lines.append("{}{{{}}} {}".format(name, labels, getattr(metrics, attribute)))
+
+            lines.append("# TYPE trivia_responses_total counter")
+            for labels, metrics in routes:
+                for status, count in sorted(metrics.responses.items()):
+                    lines.append('trivia_responses_total{{{},status="{}"}} {}'.format(labels, status, count))
+
+        return "\n".join(lines) + "\n"
+
+
+def _request_metrics():
+    if has_request_context():
+        return getattr(g, "request_metrics", None)
+    return None
+
+
+@event.listens_for(Engine, "before_cursor_execute")
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    # kept on the statement's execution context, not the pooled
+    # connection, so a statement that fails leaves nothing behind
+    context.trivia_query_started = time.perf_counter()
+
+
+@event.listens_for(Engine, "after_cursor_execute")
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = context.trivia_query_started
+    current = _request_metrics()
+    if current is not None:
+        current["statements"] += 1
+        current["db_seconds"] += time.perf_counter() - started
+
+
+@event.listens_for(db.Model, "load", propagate=True)
+def _on_load(target, context):
+    current = _request_metrics()
+    if current is not None:
+        current["rows"] += 1
+
+
+def start_request():
+    g.request_metrics = {
+        "started": time.perf_counter(),
+        "statements": 0,
+        "db_seconds": 0.0,
+        "rows": 0
+    }
+
+
+def finish_request(registry, response):
+    """
+    finish_request(registry, response)
+        records the request in the registry and adds a Server-Timing
+        header with the DB and total time
+    """
+    current = _request_metrics()
+    if current is None:
+        return response
+
+    seconds = time.perf_counter() - current["started"]
+    size = 0 if response.is_streamed else response.calculate_content_length() or 0
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+
+    registry.record(
+        route, request.method, response.status_code, seconds,
+        current["statements"], current["db_seconds"], current["rows"], size)
+
+    response.headers["Server-Timing"] = (
+        'db;dur={:.2f};desc="{} statements, {} rows", total;dur={:.2f}'.format(
+            1000 * current["db_seconds"], current["statements"],
+            current["rows"], 1000 * seconds))
+    return response
+
+
+def setup_metrics(app):
+    app.extensions['metrics'] = MetricsRegistry()
@@ -0,0 +1,226 @@
+import sys
+
+import click
+from sqlalchemy import (
+    Column, DateTime, Integer, MetaData, String, Table, Text, func, inspect, text)
+
+from models import db
+
+"""
+SchemaMigration
+    one row per applied migration. upgrade() runs every registered
+    migration that has no row yet, in version order, each in its own
+    transaction together with its bookkeeping row
+"""
+class SchemaMigration(db.Model):
+    __tablename__ = 'schema_migrations'
+
+    version = Column(Integer, primary_key=True)
+    description = Column(String, nullable=False)
+    applied_at = Column(DateTime, nullable=False, server_default=func.now())
+
+    def __init__(self, version, description):
+        self.version = version
+        self.description = description
+
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    def register(step):
+        MIGRATIONS.append((version, description, step))
+        return step
+    return register
+
+
+@migration(1, "create categories, questions and dataset_versions")
+def create_base_tables(connection):
+    # the tables as this migration creates them, independent of later
+    # models: questions.category is the original string column that
+    # migration 2 converts
+    metadata = MetaData()
+    Table(
+        'categories', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('type', String))
+    Table(
+        'questions', metadata,
+        Column('id', Integer, primary_key=True),
+        Column('question', String),
+        Column('answer', String),
+        Column('category', String),
+        Column('difficulty', Integer))
+    Table(
+        'dataset_versions', metadata,
+        Column('name', String, primary_key=True),
+        Column('version', Integer, nullable=False, default=0))
+    metadata.create_all(bind=connection, checkfirst=True)
+
+
+def rebuild_sqlite_questions(connection):
+    """
+    rebuild_sqlite_questions(connection)
+        SQLite can't alter a column's type, and CAST into a VARCHAR
+        column stores text again, so questions is recreated with an
+        integer category and its rows copied across. the table's
+        indexes go with the old one
+    """
+    connection.execute(text(
+        "CREATE TABLE questions_migrated ("
+        "id INTEGER NOT NULL PRIMARY KEY, "
+        "question VARCHAR, "
+        "answer VARCHAR, "
+        "category INTEGER REFERENCES categories (id) ON UPDATE CASCADE ON DELETE SET NULL, "
+        "difficulty INTEGER)"))
+    connection.execute(text(
+        "INSERT INTO questions_migrated (id, question, answer, category, difficulty) "
+        "SELECT id, question, answer, CAST(category AS INTEGER), difficulty FROM questions"))
+    connection.execute(text("DROP TABLE questions"))
+    connection.execute(text("ALTER TABLE questions_migrated RENAME TO questions"))
+
+
+@migration(2, "questions.category as integer foreign key to categories.id")
+def category_foreign_key(connection):
+    if connection.dialect.name != 'postgresql':
+        rebuild_sqlite_questions(connection)
+        return
+
+    connection.execute(text(
+        "ALTER TABLE questions ALTER COLUMN category TYPE integer "
+        "USING category::integer"))
+    if not inspect(connection).get_foreign_keys('questions'):
+        connection.execute(text(
+            "ALTER TABLE questions ADD CONSTRAINT questions_category_fkey "
+            "FOREIGN KEY (category) REFERENCES categories (id)"))
+
+
+@migration(3, "indexes on questions (category, id) and (difficulty)")
+def question_indexes(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_id "
+        "ON questions (category, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_difficulty "
+        "ON questions (difficulty)"))
+
+
+@migration(4, "full-text search indexes on questions")
+def search_indexes(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_search ON questions "
+        "USING GIN (to_tsvector('english'::regconfig, coalesce(question, '')))"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_search_answers ON questions "
+        "USING GIN (to_tsvector('english'::regconfig, "
+        "coalesce(question, '') || ' ' || coalesce(answer, '')))"))
+
+
+@migration(5, "indexes on questions (category, difficulty, id) and (difficulty, id)")
+def difficulty_indexes(connection):
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_category_difficulty_id "
+        "ON questions (category, difficulty, id)"))
+    connection.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_questions_difficulty_id "
+        "ON questions (difficulty, id)"))
+    # (difficulty, id) serves every lookup the single-column index did
+    connection.execute(text("DROP INDEX IF EXISTS ix_questions_difficulty"))
+
+
+@migration(6, "question_changes log replayed by in-memory indexes")
+def question_change_log(connection):
+    # the table as this migration creates it, independent of later models
+    question_changes = Table(
+        'question_changes', MetaData(),
+        Column('id', Integer, primary_key=True),
+        Column('version', Integer, nullable=False, index=True),
+        Column('event', String, nullable=False),
+        Column('question', Text, nullable=False))
+    question_changes.create(bind=connection, checkfirst=True)
+
+
+@migration(7, "integer questions.category on SQLite databases migrated before the table rebuild")
+def sqlite_category_rebuild(connection):
+    if connection.dialect.name == 'postgresql':
+        return
+
+    category = next(
+        column for column in inspect(connection).get_columns('questions')
+        if column['name'] == 'category')
+    if isinstance(category['type'], Integer):
+        return
+
+    rebuild_sqlite_questions(connection)
+    # put back the indexes of migrations 3 and 5
+    question_indexes(connection)
+    difficulty_indexes(connection)
+
+
+def applied_versions():
+    SchemaMigration.__table__.create(bind=db.engine, checkfirst=True)
+    return {version for version, in db.session.query(SchemaMigration.version).all()}
+
+
+def upgrade(target=None):
+    """
+    upgrade(target=None)
+        applies pending migrations up to target (default: all) and
+        returns the versions applied. needs an application context
+    """
+    applied = applied_versions()
+    db.session.commit()
+    ran = []
+
+    for version, description, step in sorted(MIGRATIONS, key=lambda entry: entry[0]):
+        if version in applied or (target is not None and version > target):
+            continue
+        try:
+            step(db.session.connection())
+            db.session.add(SchemaMigration(version, description))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        ran.append(version)
+
+    return ran
+
+
+def pending_versions():
+    """
+    pending_versions()
+        versions of the registered migrations not yet applied, without
+        creating the bookkeeping table. needs an application context
+    """
+    if db.engine.dialect.has_table(db.engine, SchemaMigration.__tablename__):
+        applied = {version for version, in db.session.query(SchemaMigration.version).all()}
+    else:
+        applied = set()
+    return sorted(version for version, _, _ in MIGRATIONS if version not in applied)
+
+
+def check_schema():
+    pending = pending_versions()
+    if pending:
+        print("pending migrations {}, run 'flask db-upgrade'".format(
+            ", ".join(str(version) for version in pending)))
+    return pending
+
+
+@click.command("db-upgrade")
+@click.option("--target", type=int, default=None, help="Stop after this migration version.")
+def upgrade_command(target):
+    """Apply pending schema migrations."""
+    for version in upgrade(target):
+        click.echo("applied {}".format(version))
+
+
+if __name__ == "__main__":
+    from flaskr import create_app
+
+    with create_app().app_context():
+        upgrade_command.main(args=sys.argv[1:], standalone_mode=False)
@@ -1,28 +1,155 @@
 import os
-from sqlalchemy import Column, String, Integer, create_engine
+from sqlalchemy import Column, String, Text, Integer, ForeignKey, Index, and_, create_engine
+from flask import g, has_request_context
 from flask_sqlalchemy import SQLAlchemy
 import json
 
+from pool import engine_options
+from replicas import RoutingSQLAlchemy
 
-DB_HOST = os.getenv('DB_HOST')
-DB_USER = os.getenv('DB_USER')
-DB_PASSWORD = os.getenv('DB_PASSWORD')
-DB_NAME = os.getenv('DB_NAME')
 
-database_path = "postgres://{}:{}@{}/{}".format(DB_USER, DB_PASSWORD, DB_HOST, DB_NAME)
+def default_database_path():
+    """
+    default_database_path()
+        the Postgres URI from the DB_HOST, DB_USER, DB_PASSWORD and
+        DB_NAME environment variables, read when the app is created
+        rather than when this module is imported
+    """
+    return "postgres://{}:{}@{}/{}".format(
+        os.getenv('DB_USER'), os.getenv('DB_PASSWORD'),
+        os.getenv('DB_HOST'), os.getenv('DB_NAME'))
 
-db = SQLAlchemy()
+
+def pool_defaults():
+    return {
+        "DB_POOL_SIZE": int(os.getenv('DB_POOL_SIZE', 5)),
+        "DB_MAX_OVERFLOW": int(os.getenv('DB_MAX_OVERFLOW', 10)),
+        "DB_POOL_TIMEOUT": int(os.getenv('DB_POOL_TIMEOUT', 30)),
+        "DB_POOL_RECYCLE": int(os.getenv('DB_POOL_RECYCLE', 1800)),
+        "DB_POOL_PRE_PING": os.getenv('DB_POOL_PRE_PING', 'true').lower() == 'true',
+        "DB_STATEMENT_TIMEOUT": int(os.getenv('DB_STATEMENT_TIMEOUT', 0)),
+    }
+
+db = RoutingSQLAlchemy()
 
 """
 setup_db(app)
-    binds a flask application and a SQLAlchemy service
+    binds a flask application and a SQLAlchemy service.
+    the schema is managed by migrations.py (flask db-upgrade),
+    not created at startup, and the engine is only created by the
+    first query. pool settings come from the DB_POOL_* and
+    DB_STATEMENT_TIMEOUT config keys, defaulting to the
+    environment variables of the same names
 """
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+def setup_db(app, database_path=None):
+    app.config["SQLALCHEMY_DATABASE_URI"] = database_path or default_database_path()
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    for key, value in pool_defaults().items():
+        app.config.setdefault(key, value)
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(app.config)
     db.app = app
     db.init_app(app)
-    db.create_all()
+
+"""
+DatasetVersion
+    one row per tracked table, bumped in the same transaction as every write
+    so that in-memory caches in any worker can tell when they are stale
+"""
+class DatasetVersion(db.Model):
+    __tablename__ = 'dataset_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+    def __init__(self, name, version=0):
+        self.name = name
+        self.version = version
+
+
+def bump_version(name):
+    updated = DatasetVersion.query.filter(DatasetVersion.name == name).update(
+        {DatasetVersion.version: DatasetVersion.version + 1},
+        synchronize_session=False)
+    if not updated:
+        db.session.add(DatasetVersion(name, version=1))
+        db.session.flush()
+    if has_request_context():
+        # the stamp indexes.read_version() remembered is now behind
+        g.pop("questions_version", None)
+    return current_version(name)
+
+
+def current_version(name):
+    version = db.session.query(DatasetVersion.version).filter(
+        DatasetVersion.name == name).scalar()
+    return version or 0
+
+"""
+QuestionChange
+    one row per question written, recorded in the same transaction as
+    the version bump, with the questions version it produced and the
+    format() snapshot of the row. a worker whose indexes are a few
+    versions behind replays these instead of reloading the table.
+    rows older than CHANGE_LOG_RETENTION versions are pruned every
+    CHANGE_LOG_PRUNE_EVERY versions
+"""
+class QuestionChange(db.Model):
+    __tablename__ = 'question_changes'
+
+    id = Column(Integer, primary_key=True)
+    version = Column(Integer, nullable=False, index=True)
+    event = Column(String, nullable=False)
+    question = Column(Text, nullable=False)
+
+
+CHANGE_LOG_RETENTION = 1000
+CHANGE_LOG_PRUNE_EVERY = 100
+
+
+def record_question_changes(event, questions, version):
+    """
+    record_question_changes(event, questions, version)
+        logs the format() snapshots written at version, with one
+        multi-row INSERT, in the current transaction
+    """
+    if questions:
+        db.session.execute(QuestionChange.__table__.insert().values([
+            {'version': version, 'event': event, 'question': json.dumps(question)}
+            for question in questions]))
+    if version % CHANGE_LOG_PRUNE_EVERY == 0:
+        db.session.execute(QuestionChange.__table__.delete().where(
+            QuestionChange.version <= version - CHANGE_LOG_RETENTION))
+
+
+def question_changes(since, until, limit):
+    """
+    question_changes(since, until, limit)
+        (version, event, question) for every change after version since
+        up to until, oldest first. None when they are more than limit
+        or the log no longer covers every version in between
+    """
+    rows = db.session.query(
+        QuestionChange.version, QuestionChange.event, QuestionChange.question
+    ).filter(
+        QuestionChange.version > since, QuestionChange.version <= until
+    ).order_by(QuestionChange.version, QuestionChange.id).limit(limit + 1).all()
+
+    if len(rows) > limit or {version for version, _, _ in rows} != set(range(since + 1, until + 1)):
+        return None
+    return [(version, event, json.loads(question)) for version, event, question in rows]
+
+"""
+question_listeners
+    callables run after every committed Question write as
+    listener(event, question, version) where question is the
+    format() snapshot of the row taken before the commit
+"""
+question_listeners = []
+
+
+def notify_question_listeners(event, question, version):
+    for listener in question_listeners:
+        listener(event, question, version)
 
 """
 Question
@@ -30,11 +157,16 @@ Question
 """
 class Question(db.Model):
     __tablename__ = 'questions'
+    __table_args__ = (
+        Index('ix_questions_category_id', 'category', 'id'),
+        Index('ix_questions_category_difficulty_id', 'category', 'difficulty', 'id'),
+        Index('ix_questions_difficulty_id', 'difficulty', 'id'),
+    )
 
     id = Column(Integer, primary_key=True)
     question = Column(String)
     answer = Column(String)
-    category = Column(String)
+    category = Column(Integer, ForeignKey('categories.id'))
     difficulty = Column(Integer)
 
     def __init__(self, question, answer, category, difficulty):
@@ -45,14 +177,66 @@ class Question(db.Model):
 
     def insert(self):
         db.session.add(self)
+        db.session.flush()
+        snapshot = self.format()
+        version = bump_version(self.__tablename__)
+        record_question_changes('insert', [snapshot], version)
         db.session.commit()
+        notify_question_listeners('insert', snapshot, version)
 
     def update(self):
+        snapshot = self.format()
+        version = bump_version(self.__tablename__)
+        record_question_changes('update', [snapshot], version)
         db.session.commit()
+        notify_question_listeners('update', snapshot, version)
 
     def delete(self):
+        snapshot = self.format()
         db.session.delete(self)
+        version = bump_version(self.__tablename__)
+        record_question_changes('delete', [snapshot], version)
+        db.session.commit()
+        notify_question_listeners('delete', snapshot, version)
+
+    @classmethod
+    def delete_where(cls, *criteria):
+        """
+        deletes every question matching criteria with one set-based
+        DELETE ... WHERE in a single transaction and returns the deleted
+        ids. Postgres reports the rows with RETURNING; elsewhere they are
+        selected first in the same transaction.
+        the rows go to the change log under one version bump, which
+        other workers' indexes replay; this worker's catch up the same way
+        """
+        table = cls.__table__
+        delete = table.delete().where(and_(*criteria))
+        if db.session.get_bind(cls.__mapper__).dialect.name == 'postgresql':
+            rows = sorted(db.session.execute(
+                delete.returning(*(table.c[field] for field in cls.FIELDS))))
+        else:
+            rows = db.session.query(*cls.columns()).filter(*criteria).order_by(cls.id).all()
+            if rows:
+                db.session.execute(delete)
+        if rows:
+            version = bump_version(cls.__tablename__)
+            record_question_changes('delete', [cls.format_row(row) for row in rows], version)
         db.session.commit()
+        return [row[0] for row in rows]
+
+    FIELDS = ('id', 'question', 'answer', 'category', 'difficulty')
+
+    @classmethod
+    def columns(cls, fields=FIELDS):
+        return tuple(getattr(cls, field) for field in fields)
+
+    @staticmethod
+    def format_row(row, fields=FIELDS):
+        """
+        format() for a plain row selected with Question.columns(fields),
+        skipping ORM hydration. only the selected fields are returned
+        """
+        return dict(zip(fields, row))
 
     def format(self):
         return {
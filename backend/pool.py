@@ -0,0 +1,123 @@
+import threading
+import time
+
+from sqlalchemy import event
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool
+
+"""
+PoolMetrics
+    running counters for connection checkouts: how many, how long
+    callers waited for a free connection, how many gave up, and how
+    many connections were invalidated (e.g. by pre-ping after failover)
+"""
+class PoolMetrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.checkouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.timeouts = 0
+        self.connects = 0
+        self.invalidations = 0
+
+    def record_wait(self, seconds):
+        with self.lock:
+            self.checkouts += 1
+            self.wait_total += seconds
+            self.wait_max = max(self.wait_max, seconds)
+
+    def as_dict(self):
+        return {
+            "checkouts": self.checkouts,
+            "wait_avg_ms": round(1000 * self.wait_total / self.checkouts, 3) if self.checkouts else 0,
+            "wait_max_ms": round(1000 * self.wait_max, 3),
+            "timeouts": self.timeouts,
+            "connects": self.connects,
+            "invalidations": self.invalidations
+        }
+
+
+"""
+TimedQueuePool
+    QueuePool that times how long each checkout waits for a connection
+"""
+class TimedQueuePool(QueuePool):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.metrics = PoolMetrics()
+        event.listen(self, 'connect', self._on_connect)
+        event.listen(self, 'invalidate', self._on_invalidate)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            self.metrics.timeouts += 1
+            raise
+        self.metrics.record_wait(time.perf_counter() - started)
+        return connection
+
+    def _on_connect(self, dbapi_connection, connection_record):
+        self.metrics.connects += 1
+
+    def _on_invalidate(self, dbapi_connection, connection_record, exception):
+        self.metrics.invalidations += 1
+
+
+def engine_options(config):
+    """
+    engine_options(config)
+        SQLALCHEMY_ENGINE_OPTIONS for the DB_POOL_* and
+        DB_STATEMENT_TIMEOUT settings in config. pool settings only
+        apply to server databases, not SQLite
+    """
+    if config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite"):
+        return {}
+
+    options = {
+        "poolclass": TimedQueuePool,
+        "pool_size": config["DB_POOL_SIZE"],
+        "max_overflow": config["DB_MAX_OVERFLOW"],
+        "pool_timeout": config["DB_POOL_TIMEOUT"],
+        "pool_recycle": config["DB_POOL_RECYCLE"],
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+    }
+    if config["DB_STATEMENT_TIMEOUT"]:
+        options["connect_args"] = {
+            "options": "-c statement_timeout={}".format(config["DB_STATEMENT_TIMEOUT"])}
+    return options
+
+
+def pool_status(pool):
+    """
+    pool_status(pool)
+        current occupancy of the engine's pool and its checkout metrics
+    """
+    status = {"class": type(pool).__name__}
+
+    if isinstance(pool, QueuePool):
+        capacity = pool.size() + max(pool._max_overflow, 0)
+        checked_out = pool.checkedout()
+        status.update({
+            "size": pool.size(),
+            "max_overflow": pool._max_overflow,
+            "checked_out": checked_out,
+            "checked_in": pool.checkedin(),
+            "overflow": max(pool.overflow(), 0),
+            "saturation": round(checked_out / capacity, 3) if capacity else 0
+        })
+
+    metrics = getattr(pool, "metrics", None)
+    if metrics is not None:
+        status.update(metrics.as_dict())
+
+    return status
@@ -0,0 +1,486 @@
+import atexit
+import hashlib
+import mmap
+import os
+import random
+import secrets
+import struct
+import sys
+import threading
+import time
+from array import array
+from itertools import repeat
+
+from flask import current_app
+from sqlalchemy import Integer, and_, cast, func, select, union_all
+
+from models import db, Question
+from indexes import QuestionIndex, read_version, register_index
+
+ALL_CATEGORIES = 0
+ANY_DIFFICULTY = 0
+DIFFICULTIES = (1, 2, 3, 4, 5)
+SAMPLE_ATTEMPTS = 8
+# random index probes per question the database sampler asks for
+PIVOTS_PER_PICK = 2
+
+# adaptive quizzes start at this difficulty and move one level per
+# correct (up) or wrong (down) answer among the last ADAPTIVE_WINDOW
+ADAPTIVE_START = 3
+ADAPTIVE_WINDOW = 5
+
+SNAPSHOT_MAGIC = b"TRIVQUIZ"
+SNAPSHOT_FORMAT = 2
+# magic, format, byte order, database fingerprint, questions version, deck count
+SNAPSHOT_HEADER = struct.Struct("<8sBc2x8sqI")
+# category, difficulty, first byte, number of ids
+SNAPSHOT_DECK = struct.Struct("<iiQQ")
+
+
+def next_difficulty(recent_answers):
+    """
+    next_difficulty(recent_answers)
+        the difficulty to ask next, given the player's answers so far
+        as booleans (True for correct), most recent last
+    """
+    recent = recent_answers[-ADAPTIVE_WINDOW:] if ADAPTIVE_WINDOW else []
+    level = ADAPTIVE_START + sum(1 if correct else -1 for correct in recent)
+    return min(max(level, DIFFICULTIES[0]), DIFFICULTIES[-1])
+
+
+def nearest_difficulties(difficulty):
+    return sorted(DIFFICULTIES, key=lambda level: (abs(level - difficulty), level))
+
+
+def draw(deck, excluded, count=1):
+    """
+    draw(deck, excluded, count=1)
+        up to count distinct random ids of deck that are not excluded.
+        tries O(1) random picks before falling back to filtering
+    """
+    excluded = set(excluded)
+    picks = []
+    attempts = SAMPLE_ATTEMPTS * count
+    while len(picks) < count and attempts and len(excluded) < len(deck):
+        attempts -= 1
+        candidate = random.choice(deck)
+        if candidate not in excluded:
+            picks.append(candidate)
+            excluded.add(candidate)
+
+    if len(picks) < count:
+        remaining = [question_id for question_id in deck if question_id not in excluded]
+        picks += random.sample(remaining, min(count - len(picks), len(remaining)))
+    return picks
+
+
+def sample_adaptive(sampler, category_id, previous_questions, difficulty, count=1):
+    """
+    sample_adaptive(sampler, category_id, previous_questions, difficulty, count=1)
+        up to count question ids at the difficulty, topped up from the
+        nearest difficulties with unplayed questions left, as
+        (question ids, difficulty of the first one)
+    """
+    excluded = set(previous_questions)
+    picks = []
+    level = difficulty
+    for candidate_level in nearest_difficulties(difficulty):
+        drawn = sampler.sample(category_id, excluded, candidate_level, count - len(picks))
+        if drawn and not picks:
+            level = candidate_level
+        picks += drawn
+        excluded.update(drawn)
+        if len(picks) == count:
+            break
+    return picks, level
+
+
+"""
+QuizSampler
+    array('i') decks of question ids keyed by (category, difficulty),
+    where category 0 is the 'all' deck and difficulty 0 any difficulty,
+    so a quiz step picks a random id without fetching any candidate
+    rows. a question sits in one deck of each of the four kinds (all
+    or one category, any or one difficulty), so four array('i')
+    indexed by question id hold its position in each, -1 when absent,
+    and a removal swaps the last id into the gap in O(1).
+
+    with a snapshot path the decks are written to disk at exit and
+    memory-mapped by the next worker whose database is at the same
+    version stamp, so it serves quizzes without reading the table.
+    mapped decks are read-only views shared with the other workers
+    on the host; a deck is copied into an array on its first write,
+    and the position arrays are built on the first write to any deck
+"""
+def deck_kind(key):
+    category, difficulty = key
+    return (category != ALL_CATEGORIES) * 2 + (difficulty != ANY_DIFFICULTY)
+
+
+class QuizSampler(QuestionIndex):
+
+    def __init__(self, snapshot_path=None, fingerprint=b""):
+        super().__init__()
+        self.snapshot_path = snapshot_path
+        self.fingerprint = hashlib.sha1(fingerprint).digest()[:8]
+        self.decks = {}
+        self.positions = None
+
+    def load(self):
+        self.decks = {}
+        self.positions = [array("i") for _ in range(4)]
+        rows = db.session.query(Question.id, Question.category, Question.difficulty).all()
+        for question_id, category, difficulty in rows:
+            self.add(question_id, category, difficulty)
+
+    def rebuild(self):
+        version = read_version()
+        with self.lock:
+            if self.is_current(version):
+                return
+            if self.load_snapshot(version):
+                self.version = version
+            else:
+                self.version = self.load_at(version)
+
+    def deck_keys(self, category, difficulty):
+        categories = [ALL_CATEGORIES]
+        if category is not None:
+            categories.append(int(category))
+        difficulties = [ANY_DIFFICULTY]
+        if difficulty is not None:
+            difficulties.append(int(difficulty))
+        return [(category, difficulty) for category in categories for difficulty in difficulties]
+
+    def writable(self, key):
+        deck = self.decks.get(key)
+        if not isinstance(deck, array):
+            copy = array("i")
+            if deck is not None:
+                copy.frombytes(deck.cast("B"))
+            deck = self.decks[key] = copy
+        return deck
+
+    def position_arrays(self):
+        if self.positions is None:
+            self.positions = [array("i") for _ in range(4)]
+            for key, deck in self.decks.items():
+                for position, question_id in enumerate(deck):
+                    self.place(key, question_id, position)
+        return self.positions
+
+    def place(self, key, question_id, position):
+        positions = self.positions[deck_kind(key)]
+        if question_id >= len(positions):
+            # grow geometrically, so appending ids in order stays O(1)
+            size = max(question_id + 1, 2 * len(positions))
+            positions.extend(repeat(-1, size - len(positions)))
+        positions[question_id] = position
+
+    def add(self, question_id, category, difficulty):
+        self.position_arrays()
+        for key in self.deck_keys(category, difficulty):
+            deck = self.writable(key)
+            self.place(key, question_id, len(deck))
+            deck.append(question_id)
+
+    def remove(self, question_id, question=None):
+        """
+        remove(question_id, question=None)
+            swap-removes the id from the decks of the question's category
+            and difficulty, checking every deck when they aren't known.
+            only decks that hold the id are copied out of the snapshot
+        """
+        if question is None:
+            keys = list(self.decks)
+        else:
+            keys = self.deck_keys(question['category'], question['difficulty'])
+
+        arrays = self.position_arrays()
+        for key in keys:
+            deck = self.decks.get(key)
+            positions = arrays[deck_kind(key)]
+            if deck is None or question_id >= len(positions):
+                continue
+            position = positions[question_id]
+            # the id's position of this kind may belong to another deck
+            if not 0 <= position < len(deck) or deck[position] != question_id:
+                continue
+            deck = self.writable(key)
+            positions[question_id] = -1
+            last = deck.pop()
+            if position < len(deck):
+                deck[position] = last
+                positions[last] = position
+
+    def apply(self, event, question):
+        if event == 'insert':
+            self.add(question['id'], question['category'], question['difficulty'])
+            return
+
+        # an update may have moved the question out of its old decks
+        self.remove(question['id'], question if event == 'delete' else None)
+        if event == 'update':
+            self.add(question['id'], question['category'], question['difficulty'])
+
+    def save_snapshot(self):
+        """
+        save_snapshot()
+            writes the decks and their version stamp to snapshot_path.
+            the file is replaced atomically, so workers that have the
+            previous one mapped keep reading it unchanged
+        """
+        with self.lock:
+            if self.snapshot_path is None or self.version is None:
+                return False
+
+            decks = sorted(self.decks.items())
+            offset = SNAPSHOT_HEADER.size + SNAPSHOT_DECK.size * len(decks)
+            temporary = "{}.{}.tmp".format(self.snapshot_path, os.getpid())
+            with open(temporary, "wb") as snapshot:
+                snapshot.write(SNAPSHOT_HEADER.pack(
+                    SNAPSHOT_MAGIC, SNAPSHOT_FORMAT, sys.byteorder[0].encode("ascii"),
+                    self.fingerprint, self.version, len(decks)))
+                for (category, difficulty), deck in decks:
+                    snapshot.write(SNAPSHOT_DECK.pack(category, difficulty, offset, len(deck)))
+                    offset += len(deck) * 4
+                for key, deck in decks:
+                    snapshot.write(memoryview(deck).cast("B"))
+            os.replace(temporary, self.snapshot_path)
+            return True
+
+    def load_snapshot(self, version):
+        """
+        load_snapshot(version)
+            maps the decks from snapshot_path when it was written for
+            this database at this version stamp, else returns False
+        """
+        if self.snapshot_path is None:
+            return False
+
+        try:
+            with open(self.snapshot_path, "rb") as snapshot:
+                mapped = mmap.mmap(snapshot.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+
+        if len(mapped) < SNAPSHOT_HEADER.size:
+            return False
+        magic, snapshot_format, byteorder, fingerprint, saved_version, count = \
+            SNAPSHOT_HEADER.unpack_from(mapped)
+        if (magic != SNAPSHOT_MAGIC or snapshot_format != SNAPSHOT_FORMAT
+                or byteorder != sys.byteorder[0].encode("ascii")
+                or fingerprint != self.fingerprint or saved_version != version):
+            return False
+
+        view = memoryview(mapped)
+        decks = {}
+        for number in range(count):
+            category, difficulty, start, length = SNAPSHOT_DECK.unpack_from(
+                mapped, SNAPSHOT_HEADER.size + SNAPSHOT_DECK.size * number)
+            decks[(category, difficulty)] = view[start:start + length * 4].cast("i")
+        self.decks = decks
+        self.positions = None
+        return True
+
+    def sample(self, category_id, previous_questions, difficulty=ANY_DIFFICULTY, count=1):
+        """
+        sample(category_id, previous_questions, difficulty=ANY_DIFFICULTY, count=1)
+            up to count distinct random question ids in the category, and
+            at the difficulty if one is given, that are not in
+            previous_questions. empty when there is none left
+        """
+        with self.lock:
+            deck = self.decks.get((int(category_id), difficulty), [])
+            return draw(deck, previous_questions, count)
+
+    def question_ids(self, category_id, excluded):
+        with self.lock:
+            deck = self.decks.get((int(category_id), ANY_DIFFICULTY))
+            if deck is None:
+                return array("i")
+            if excluded:
+                return array("i", (question_id for question_id in deck if question_id not in excluded))
+            copy = array("i")
+            copy.frombytes(memoryview(deck).cast("B"))
+            return copy
+
+
+"""
+DatabaseSampler
+    the same sampling interface reading the questions table instead of
+    holding decks in memory. a draw of count questions is one statement:
+    a UNION ALL of PIVOTS_PER_PICK * count branches, each taking the
+    first id at or above a random pivot between the selection's lowest
+    and highest id through the (category, difficulty, id) and
+    (difficulty, id) indexes. only when too few distinct unplayed ids
+    come back is a second ORDER BY random() query run to top up. ids
+    that follow large gaps are drawn somewhat more often than others
+"""
+class DatabaseSampler:
+
+    def criteria(self, category_id, difficulty):
+        criteria = []
+        if int(category_id) != ALL_CATEGORIES:
+            criteria.append(Question.category == int(category_id))
+        if difficulty != ANY_DIFFICULTY:
+            criteria.append(Question.difficulty == difficulty)
+        return criteria
+
+    def selection(self, category_id, difficulty):
+        return db.session.query(Question.id).filter(*self.criteria(category_id, difficulty))
+
+    def sample(self, category_id, previous_questions, difficulty=ANY_DIFFICULTY, count=1):
+        excluded = set(previous_questions)
+        criteria = self.criteria(category_id, difficulty)
+
+        bounds = select([
+            func.min(Question.id).label("low"),
+            func.max(Question.id).label("high")]).where(and_(*criteria)).cte("bounds")
+        branches = []
+        for _ in range(PIVOTS_PER_PICK * count):
+            pivot = select([cast(
+                bounds.c.low + random.random() * (bounds.c.high - bounds.c.low),
+                Integer)]).as_scalar()
+            probe = select([Question.id]).where(and_(Question.id >= pivot, *criteria)).order_by(
+                Question.id).limit(1).alias()
+            branches.append(select([probe.c.id]))
+
+        picks = []
+        for candidate, in db.session.execute(union_all(*branches)):
+            if candidate not in excluded:
+                picks.append(candidate)
+                excluded.add(candidate)
+                if len(picks) == count:
+                    return picks
+
+        query = self.selection(category_id, difficulty)
+        query = query.filter(~Question.id.in_(excluded)) if excluded else query
+        return picks + [question_id for question_id, in query.order_by(
+            func.random()).limit(count - len(picks)).all()]
+
+    def question_ids(self, category_id, excluded):
+        query = self.selection(category_id, ANY_DIFFICULTY)
+        return array("i", (question_id for question_id, in query.all() if question_id not in excluded))
+
+
+"""
+QuizSession
+    one player's game: a private array('i') copy of the category's ids,
+    4 bytes per question, that is shuffled lazily, one Fisher-Yates step
+    per question drawn, so each next() is O(1) and never repeats a
+    question. sessions pickle without their lock, for shared stores
+"""
+class QuizSession:
+
+    def __init__(self, category_id, question_ids):
+        self.category_id = category_id
+        self.deck = question_ids
+        self.position = 0
+        self.lock = threading.Lock()
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state["lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.lock = threading.Lock()
+
+    def remaining(self):
+        return len(self.deck) - self.position
+
+    def next(self):
+        with self.lock:
+            if self.position >= len(self.deck):
+                return None
+            swap = random.randrange(self.position, len(self.deck))
+            deck = self.deck
+            deck[self.position], deck[swap] = deck[swap], deck[self.position]
+            self.position += 1
+            return deck[self.position - 1]
+
+
+"""
+MemorySessionStore
+    quiz sessions held in process memory, evicted once they have not
+    been touched for ttl seconds. only the worker that created a session
+    can serve it, so deployments with several workers must pass a store
+    shared between them as QUIZ_SESSION_STORE, with the same
+    create(session), get(session_id) and save(session_id, session)
+    interface; save() is called after every step to write it back
+"""
+class MemorySessionStore:
+
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.sessions = {}
+        self.next_sweep = time.monotonic() + ttl
+
+    def sweep(self, now):
+        expired = [
+            session_id for session_id, (_, touched) in self.sessions.items()
+            if now - touched > self.ttl]
+        for session_id in expired:
+            del self.sessions[session_id]
+        self.next_sweep = now + self.ttl
+
+    def create(self, session):
+        session_id = secrets.token_urlsafe(16)
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            self.sessions[session_id] = (session, now)
+        return session_id
+
+    def get(self, session_id):
+        now = time.monotonic()
+        with self.lock:
+            entry = self.sessions.get(session_id)
+            if entry is None or now - entry[1] > self.ttl:
+                self.sessions.pop(session_id, None)
+                return None
+            self.sessions[session_id] = (entry[0], now)
+            return entry[0]
+
+    def save(self, session_id, session):
+        # the stored object is the one next() advanced
+        pass
+
+
+def start_session(category_id, previous_questions=()):
+    question_ids = quiz_sampler().question_ids(category_id, set(previous_questions))
+    return QuizSession(int(category_id), question_ids)
+
+
+def setup_quiz(app):
+    backend = app.config.get('QUIZ_SAMPLER', 'memory')
+    snapshot_path = app.config.get('QUIZ_SNAPSHOT')
+
+    if backend == 'memory':
+        sampler = register_index(app, 'quiz', QuizSampler(
+            snapshot_path, app.config['SQLALCHEMY_DATABASE_URI'].encode('utf-8')))
+        if snapshot_path is not None:
+            atexit.register(sampler.save_snapshot)
+    elif backend == 'database':
+        sampler = DatabaseSampler()
+    else:
+        raise ValueError("Unknown QUIZ_SAMPLER: {}".format(backend))
+
+    app.extensions['quiz_sampler'] = sampler
+    app.extensions['quiz_sessions'] = app.config.get('QUIZ_SESSION_STORE') or \
+        MemorySessionStore(app.config.get('QUIZ_SESSION_TTL', 3600))
+
+
+def quiz_sessions():
+    return current_app.extensions['quiz_sessions']
+
+
+def quiz_sampler():
+    sampler = current_app.extensions['quiz_sampler']
+    if isinstance(sampler, QuestionIndex):
+        sampler.refresh()
+    return sampler
@@ -0,0 +1,166 @@
+import functools
+import threading
+import time
+
+from flask import current_app, g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm
+from sqlalchemy.engine.url import make_url
+
+from pool import engine_options, pool_status
+
+"""
+read replicas, configured with DB_REPLICA_URIS in the create_app
+config. views decorated with @reads_from_replica run their queries on
+one replica, picked round-robin per request; everything else, and any
+flush, uses the primary. a client that has just written is sent to the
+primary for DB_REPLICA_STICKY_SECONDS, so it reads its own writes
+while the replicas catch up
+"""
+
+STICKY_COOKIE = "trivia_primary_until"
+
+"""
+ReplicaSet
+    the replica engines, their round-robin position and health.
+    a replica is probed with SELECT 1 at most every check_interval
+    seconds when it comes up for selection, and is skipped while the
+    last probe, or a dropped connection, marked it down
+"""
+class ReplicaSet:
+
+    def __init__(self, uris, config, check_interval):
+        self.uris = uris
+        self.config = config
+        self.check_interval = check_interval
+        self.lock = threading.Lock()
+        self.position = 0
+        self.engines = [None] * len(uris)
+        self.healthy = [True] * len(uris)
+        self.next_check = [0.0] * len(uris)
+
+    def engine(self, number):
+        # created on first selection, like the primary's engine
+        with self.lock:
+            if self.engines[number] is None:
+                uri = self.uris[number]
+                engine = create_engine(
+                    uri, **engine_options(dict(self.config, SQLALCHEMY_DATABASE_URI=uri)))
+                event.listen(engine, "handle_error", functools.partial(self.on_error, number))
+                self.engines[number] = engine
+            return self.engines[number]
+
+    def on_error(self, number, context):
+        if context.is_disconnect:
+            self.mark(number, False)
+
+    def mark(self, number, healthy):
+        self.healthy[number] = healthy
+        self.next_check[number] = time.monotonic() + self.check_interval
+
+    def check(self, number):
+        try:
+            with self.engine(number).connect() as connection:
+                connection.execute("SELECT 1")
+            healthy = True
+        except Exception as e:
+            print(e)
+            healthy = False
+        self.mark(number, healthy)
+        return healthy
+
+    def choose(self):
+        """
+        choose()
+            the next healthy replica engine in turn, or None when every
+            replica is down
+        """
+        for _ in range(len(self.engines)):
+            with self.lock:
+                number = self.position
+                self.position = (self.position + 1) % len(self.engines)
+                due = time.monotonic() >= self.next_check[number]
+                if due:
+                    # other threads skip the probe until it is due again
+                    self.next_check[number] = time.monotonic() + self.check_interval
+
+            if self.check(number) if due else self.healthy[number]:
+                return self.engine(number)
+        return None
+
+    def status(self):
+        return [
+            {
+                "url": repr(make_url(uri)),
+                "healthy": self.healthy[number],
+                "pool": pool_status(engine.pool) if engine is not None else None
+            }
+            for number, (uri, engine) in enumerate(zip(self.uris, self.engines))]
+
+
+"""
+RoutingSession
+    Flask-SQLAlchemy session that binds the queries of a replica-routed
+    request to that request's replica. flushes always go to the primary
+"""
+class RoutingSession(SignallingSession):
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context():
+            replica = g.get("replica")
+            if replica is not None:
+                return replica
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def setup_replicas(app):
+    uris = app.config.get("DB_REPLICA_URIS") or []
+    app.config.setdefault("DB_REPLICA_STICKY_SECONDS", 5)
+
+    app.extensions["replicas"] = ReplicaSet(
+        uris, app.config, app.config.get("DB_REPLICA_CHECK_INTERVAL", 10)) if uris else None
+
+    @app.after_request
+    def stick_to_primary(response):
+        # a successful write keeps this client on the primary for a while
+        if (app.extensions["replicas"] is not None
+                and request.method not in ("GET", "HEAD", "OPTIONS")
+                and not g.get("read_only", False) and response.status_code < 400):
+            sticky_seconds = app.config["DB_REPLICA_STICKY_SECONDS"]
+            response.set_cookie(
+                STICKY_COOKIE, str(int(time.time() + sticky_seconds)),
+                max_age=sticky_seconds, httponly=True)
+        return response
+
+
+def replica_status():
+    replicas = current_app.extensions.get("replicas")
+    return replicas.status() if replicas is not None else []
+
+
+def reads_from_replica(view):
+    """
+    reads_from_replica(view)
+        runs the view's queries on a replica unless this client wrote
+        within the sticky window or no replica is healthy
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        replicas = current_app.extensions.get("replicas")
+        g.read_only = True
+        if replicas is not None:
+            try:
+                primary_until = int(request.cookies.get(STICKY_COOKIE, 0))
+            except ValueError:
+                primary_until = 0
+            if time.time() >= primary_until:
+                g.replica = replicas.choose()
+        return view(*args, **kwargs)
+
+    return wrapper
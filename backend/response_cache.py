@@ -0,0 +1,322 @@
+import functools
+import hashlib
+import json
+import os
+import socket
+import threading
+from collections import OrderedDict
+from urllib.parse import urlparse
+
+from flask import current_app, request
+
+from counts import question_counts, lagging_read
+from category_cache import category_cache
+
+"""
+response caches for read endpoints, selected with RESPONSE_CACHE:
+'memory' (default, per worker), 'filesystem' (shared by the workers
+of one host through RESPONSE_CACHE_DIR) or 'redis' (shared by all
+hosts through any Redis-protocol server at RESPONSE_CACHE_URL).
+None disables caching. keys carry the questions version stamp, so a
+Question.insert()/update()/delete() in any worker retires every page
+"""
+
+ENTRY_FIELDS = {"mimetype", "etag", "weak", "headers"}
+
+
+class CacheStats:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def count(self, attribute, amount=1):
+        with self.lock:
+            setattr(self, attribute, getattr(self, attribute) + amount)
+
+
+"""
+MemoryCache
+    LRU dict of up to max_entries values in this worker
+"""
+class MemoryCache:
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.stats = CacheStats()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+        self.stats.count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.stats.count("evictions")
+
+
+"""
+FileCache
+    one file per response under directory, shared by every worker on the
+    host. reads touch the file's mtime, so evicting the oldest mtimes
+    once there are more than max_entries files is LRU
+"""
+class FileCache:
+
+    def __init__(self, directory, max_entries):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.stats = CacheStats()
+        self.writes = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode("utf-8")).hexdigest())
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, "rb") as cached:
+                value = cached.read()
+            os.utime(path)
+        except OSError:
+            self.stats.count("misses")
+            return None
+        self.stats.count("hits")
+        return value
+
+    def set(self, key, value):
+        path = self.path(key)
+        temporary = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(temporary, "wb") as cached:
+            cached.write(value)
+        os.replace(temporary, path)
+
+        self.writes += 1
+        if self.writes % 64 == 0:
+            self.evict()
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                continue
+            try:
+                entries.append((os.stat(os.path.join(self.directory, name)).st_mtime, name))
+            except OSError:
+                continue
+
+        entries.sort()
+        for _, name in entries[:max(len(entries) - self.max_entries, 0)]:
+            try:
+                os.remove(os.path.join(self.directory, name))
+                self.stats.count("evictions")
+            except OSError:
+                pass
+
+
+"""
+RedisCache
+    GET/SET with a TTL against a Redis-protocol server, speaking RESP
+    directly so no client library is needed. the size bound and LRU
+    eviction are the server's: run it with maxmemory and
+    maxmemory-policy allkeys-lru
+"""
+class RedisCache:
+
+    def __init__(self, url, ttl):
+        parsed = urlparse(url)
+        self.address = (parsed.hostname or "localhost", parsed.port or 6379)
+        self.database = int(parsed.path.lstrip("/") or 0)
+        self.password = parsed.password
+        self.ttl = ttl
+        self.local = threading.local()
+        self.stats = CacheStats()
+
+    def connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            sock = socket.create_connection(self.address, timeout=1.0)
+            connection = self.local.connection = (sock, sock.makefile("rb"))
+            if self.password:
+                self.command(b"AUTH", self.password.encode("utf-8"))
+            if self.database:
+                self.command(b"SELECT", str(self.database).encode("ascii"))
+        return connection
+
+    def command(self, *arguments):
+        sock, reader = self.connection()
+        payload = [b"*%d\r\n" % len(arguments)]
+        for argument in arguments:
+            payload.append(b"$%d\r\n%s\r\n" % (len(argument), argument))
+        try:
+            sock.sendall(b"".join(payload))
+            return self.read_reply(reader)
+        except (OSError, ValueError):
+            # closed or out of step, the next command reconnects
+            self.local.connection = None
+            sock.close()
+            raise
+
+    def read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b"\r\n"):
+            raise ConnectionError("Redis closed the connection")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"$":
+            length = int(rest)
+            if length < 0:
+                return None
+            value = reader.read(length + 2)
+            if len(value) < length + 2:
+                raise ConnectionError("Redis closed the connection")
+            return value[:-2]
+        if kind == b"-":
+            raise RuntimeError(rest.decode("utf-8", "replace"))
+        return rest
+
+    def get(self, key):
+        try:
+            value = self.command(b"GET", key.encode("utf-8"))
+        except (OSError, ValueError, RuntimeError) as e:
+            print(e)
+            value = None
+        self.stats.count("hits" if value is not None else "misses")
+        return value
+
+    def set(self, key, value):
+        try:
+            self.command(b"SET", key.encode("utf-8"), value, b"EX", str(self.ttl).encode("ascii"))
+        except (OSError, ValueError, RuntimeError) as e:
+            print(e)
+
+
+def setup_response_cache(app):
+    backend = app.config.get("RESPONSE_CACHE", "memory")
+    size = app.config.get("RESPONSE_CACHE_SIZE", 1024)
+
+    if backend is None:
+        cache = None
+    elif backend == "memory":
+        cache = MemoryCache(size)
+    elif backend == "filesystem":
+        cache = FileCache(app.config.get("RESPONSE_CACHE_DIR", "/tmp/trivia-cache"), size)
+    elif backend == "redis":
+        cache = RedisCache(
+            app.config.get("RESPONSE_CACHE_URL", "redis://localhost:6379/0"),
+            app.config.get("RESPONSE_CACHE_TTL", 300))
+    else:
+        raise ValueError("Unknown RESPONSE_CACHE: {}".format(backend))
+
+    app.extensions["response_cache"] = cache
+
+
+def cache_key():
+    """
+    cache_key()
+        path and sorted query arguments of the current request with the
+        questions version stamp and the categories validator
+    """
+    counts = question_counts()
+    cache = category_cache()
+    cache.get()
+    arguments = sorted(request.args.items(multi=True))
+    return "trivia:{}:{}:{}?{}".format(
+        counts.version, cache.etag, request.path,
+        "&".join("{}={}".format(name, value) for name, value in arguments))
+
+
+def decode_entry(entry):
+    """
+    decode_entry(entry)
+        the (meta, body) of a cached entry, or None when it is damaged,
+        which the caller treats as a miss
+    """
+    try:
+        header, body = entry.split(b"\n", 1)
+        meta = json.loads(header.decode("utf-8"))
+    except ValueError as e:
+        print(e)
+        return None
+    if (not isinstance(meta, dict) or not ENTRY_FIELDS <= meta.keys()
+            or not isinstance(meta["headers"], dict)):
+        print("Damaged response cache entry")
+        return None
+    return meta, body
+
+
+def cached(view):
+    """
+    cached(view)
+        serves the view's 200 responses from the configured response
+        cache, answering If-None-Match from the cached ETag
+    """
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        cache = current_app.extensions.get("response_cache")
+        if cache is None or lagging_read():
+            # a lagging replica's page would be stored under a newer stamp
+            return view(*args, **kwargs)
+
+        key = cache_key()
+        entry = cache.get(key)
+        entry = decode_entry(entry) if entry is not None else None
+        if entry is not None:
+            meta, body = entry
+            if meta["etag"] and request.if_none_match.contains_weak(meta["etag"]):
+                response = current_app.response_class(status=304)
+            else:
+                response = current_app.response_class(body, mimetype=meta["mimetype"])
+            if meta["etag"]:
+                response.set_etag(meta["etag"], weak=meta["weak"])
+            for name, value in meta["headers"].items():
+                response.headers[name] = value
+            return response
+
+        response = current_app.make_response(view(*args, **kwargs))
+        if response.status_code == 200 and not response.is_streamed:
+            etag, weak = response.get_etag()
+            meta = {
+                "mimetype": response.mimetype,
+                "etag": etag,
+                "weak": weak,
+                "headers": {
+                    name: value for name, value in response.headers.items()
+                    if name == "Cache-Control"}
+            }
+            cache.set(key, json.dumps(meta).encode("utf-8") + b"\n" + response.get_data())
+        return response
+
+    return wrapper
+
+
+def render_cache_metrics():
+    """
+    render_cache_metrics()
+        Prometheus counters of the response cache and, when enabled,
+        the search result cache
+    """
+    lines = []
+    for extension in ("response_cache", "search_cache"):
+        cache = current_app.extensions.get(extension)
+        if cache is None:
+            continue
+
+        for name in ("hits", "misses", "evictions"):
+            lines.append("# TYPE trivia_{}_{}_total counter".format(extension, name))
+            lines.append("trivia_{}_{}_total {}".format(extension, name, getattr(cache.stats, name)))
+        if isinstance(cache, MemoryCache):
+            lines.append("# TYPE trivia_{}_entries gauge".format(extension))
+            lines.append("trivia_{}_entries {}".format(extension, len(cache.entries)))
+    return "\n".join(lines) + "\n" if lines else ""
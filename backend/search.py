@@ -0,0 +1,276 @@
+import heapq
+import re
+from bisect import bisect_left, insort
+from collections import Counter
+
+from flask import current_app
+from sqlalchemy import func, literal_column
+from sqlalchemy.engine.url import make_url
+
+from models import db, Question
+from indexes import QuestionIndex, register_index, get_index
+from counts import question_counts, lagging_read
+from response_cache import MemoryCache
+
+TOKEN_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+
+def tokenize(value):
+    return TOKEN_PATTERN.findall((value or "").lower())
+
+
+"""
+PostgresSearch
+    ranked full-text search over the GIN expression indexes on
+    to_tsvector(question [|| answer]) created by migration 4.
+    every search term is matched as a prefix, so partial words
+    still find their questions
+"""
+class PostgresSearch:
+
+    def __init__(self, include_answers=False):
+        self.include_answers = include_answers
+
+    def document_sql(self):
+        if self.include_answers:
+            return "coalesce(question, '') || ' ' || coalesce(answer, '')"
+        return "coalesce(question, '')"
+
+    def search(self, term, offset, limit, fields=Question.FIELDS):
+        terms = tokenize(term)
+        if not terms:
+            return [], 0
+
+        document = func.to_tsvector(
+            literal_column("'english'::regconfig"),
+            literal_column(self.document_sql()))
+        query = func.to_tsquery(
+            literal_column("'english'::regconfig"),
+            " & ".join("{}:*".format(term) for term in terms))
+
+        selection = db.session.query(*Question.columns(fields)).filter(
+            document.op('@@')(query))
+        total = selection.count()
+        questions = selection.order_by(
+            func.ts_rank(document, query).desc(), Question.id
+        ).offset(offset).limit(limit).all()
+
+        return questions, total
+
+
+"""
+InvertedIndexSearch
+    in-process inverted index for SQLite and test setups.
+    maps every token to {question id: term frequency}, keeps a sorted
+    vocabulary for prefix lookups and ranks by summed term frequency
+"""
+class InvertedIndexSearch(QuestionIndex):
+
+    def __init__(self, include_answers=False):
+        super().__init__()
+        self.include_answers = include_answers
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+
+    def document_tokens(self, question, answer):
+        tokens = tokenize(question)
+        if self.include_answers:
+            tokens += tokenize(answer)
+        return Counter(tokens)
+
+    def load(self):
+        self.postings = {}
+        self.documents = {}
+        self.vocabulary = []
+        rows = db.session.query(
+            Question.id, Question.question, Question.answer).all()
+        for question_id, question, answer in rows:
+            self.add(question_id, self.document_tokens(question, answer), loading=True)
+        # sorted once, rather than an insort per new token
+        self.vocabulary = sorted(self.postings)
+
+    def add(self, question_id, tokens, loading=False):
+        self.documents[question_id] = tokens
+        for token, frequency in tokens.items():
+            if token not in self.postings:
+                self.postings[token] = {}
+                if not loading:
+                    insort(self.vocabulary, token)
+            self.postings[token][question_id] = frequency
+
+    def remove(self, question_id):
+        for token in self.documents.pop(question_id, {}):
+            postings = self.postings[token]
+            postings.pop(question_id, None)
+            if not postings:
+                del self.postings[token]
+                del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def apply(self, event, question):
+        self.remove(question['id'])
+        if event != 'delete':
+            self.add(question['id'], self.document_tokens(
+                question['question'], question['answer']))
+
+    def expand(self, prefix):
+        position = bisect_left(self.vocabulary, prefix)
+        while (position < len(self.vocabulary)
+               and self.vocabulary[position].startswith(prefix)):
+            yield self.vocabulary[position]
+            position += 1
+
+    def search(self, term, offset, limit, fields=Question.FIELDS):
+        terms = tokenize(term)
+        if not terms:
+            return [], 0
+
+        with self.lock:
+            scores = None
+            for prefix in terms:
+                matched = Counter()
+                for token in self.expand(prefix):
+                    matched.update(self.postings[token])
+                if scores is None:
+                    scores = matched
+                else:
+                    scores = Counter({
+                        question_id: scores[question_id] + score
+                        for question_id, score in matched.items()
+                        if question_id in scores})
+
+        ranked = sorted(scores, key=lambda question_id: (-scores[question_id], question_id))
+        page_ids = ranked[offset:offset + limit]
+        if not page_ids:
+            return [], len(ranked)
+
+        rows = {
+            row.id: row
+            for row in db.session.query(*Question.columns(fields)).filter(
+                Question.id.in_(page_ids)).all()}
+        return [rows[question_id] for question_id in page_ids if question_id in rows], len(ranked)
+
+
+"""
+SuggestionIndex
+    sorted vocabulary of question tokens with the number of questions
+    each one appears in. completions of a prefix are found with bisect
+    and ranked by that count, so type-ahead never reads the questions table
+"""
+class SuggestionIndex(QuestionIndex):
+
+    def __init__(self, include_answers=False):
+        super().__init__()
+        self.include_answers = include_answers
+        self.frequencies = {}
+        self.vocabulary = []
+
+    def document_tokens(self, question, answer):
+        tokens = set(tokenize(question))
+        if self.include_answers:
+            tokens.update(tokenize(answer))
+        return tokens
+
+    def load(self):
+        self.frequencies = Counter()
+        rows = db.session.query(Question.question, Question.answer).all()
+        for question, answer in rows:
+            self.frequencies.update(self.document_tokens(question, answer))
+        self.frequencies = dict(self.frequencies)
+        self.vocabulary = sorted(self.frequencies)
+
+    def apply(self, event, question):
+        if event == 'update':
+            # the previous text is unknown, rebuild
+            return False
+
+        tokens = self.document_tokens(question['question'], question['answer'])
+        for token in tokens:
+            if event == 'insert':
+                if token not in self.frequencies:
+                    self.frequencies[token] = 0
+                    insort(self.vocabulary, token)
+                self.frequencies[token] += 1
+            elif token in self.frequencies:
+                self.frequencies[token] -= 1
+                if not self.frequencies[token]:
+                    del self.frequencies[token]
+                    del self.vocabulary[bisect_left(self.vocabulary, token)]
+
+    def suggest(self, text, limit):
+        """
+        suggest(text, limit)
+            up to limit completions of text's last word, most frequent
+            first, each prefixed with the words before it
+        """
+        terms = tokenize(text)
+        if not terms:
+            return []
+
+        prefix = terms[-1]
+        with self.lock:
+            completions = []
+            position = bisect_left(self.vocabulary, prefix)
+            while (position < len(self.vocabulary)
+                   and self.vocabulary[position].startswith(prefix)):
+                completions.append(self.vocabulary[position])
+                position += 1
+            best = heapq.nsmallest(
+                limit, completions, key=lambda token: (-self.frequencies[token], token))
+
+        return [" ".join(terms[:-1] + [token]) for token in best]
+
+
+def setup_search(app):
+    backend = app.config.get('SEARCH_BACKEND', 'auto')
+    include_answers = app.config.get('SEARCH_ANSWERS', False)
+
+    if backend == 'auto':
+        # read from the URI so that no engine is created at startup
+        dialect = make_url(app.config['SQLALCHEMY_DATABASE_URI']).get_backend_name()
+        backend = 'postgres' if dialect in ('postgres', 'postgresql') else 'memory'
+
+    if backend == 'postgres':
+        search = PostgresSearch(include_answers)
+    elif backend == 'memory':
+        search = register_index(app, 'search', InvertedIndexSearch(include_answers))
+    else:
+        raise ValueError("Unknown SEARCH_BACKEND: {}".format(backend))
+
+    app.extensions['search_backend'] = search
+    register_index(app, 'suggestions', SuggestionIndex(include_answers))
+
+    size = app.config.get('SEARCH_CACHE_SIZE', 256)
+    app.extensions['search_cache'] = MemoryCache(size) if size else None
+
+
+def search_backend():
+    search = current_app.extensions['search_backend']
+    if isinstance(search, QuestionIndex):
+        search.refresh()
+    return search
+
+
+def cached_search(term, offset, limit, fields=Question.FIELDS):
+    """
+    cached_search(term, offset, limit, fields=Question.FIELDS)
+        search_backend().search(), answering repeated terms from an LRU
+        of recent results. terms are keyed by their tokens, so 'Title'
+        and 'title ' share an entry, and by the questions version
+        stamp, so any write retires every cached result. lagging reads
+        (see counts.lagging_read) bypass the cache
+    """
+    cache = current_app.extensions['search_cache']
+    if cache is None or lagging_read():
+        return search_backend().search(term, offset, limit, fields)
+
+    key = (question_counts().version, tuple(tokenize(term)), offset, limit, fields)
+    results = cache.get(key)
+    if results is None:
+        results = search_backend().search(term, offset, limit, fields)
+        cache.set(key, results)
+    return results
+
+
+def suggestions():
+    return get_index('suggestions')
@@ -0,0 +1,58 @@
+import json
+
+from flask import current_app
+
+"""
+JSON encoders for API responses, chosen with the JSON_ENCODER config
+key: 'orjson' or 'ujson' when installed, 'json' for the standard
+library, or 'auto' (default) for the fastest one available.
+every encoder sorts keys like flask.jsonify, so payloads keep their shape
+"""
+
+
+def _stdlib_encoder():
+    return lambda payload: json.dumps(payload, sort_keys=True).encode("utf-8")
+
+
+def _orjson_encoder():
+    import orjson
+
+    options = orjson.OPT_NON_STR_KEYS | orjson.OPT_SORT_KEYS
+    return lambda payload: orjson.dumps(payload, option=options)
+
+
+def _ujson_encoder():
+    import ujson
+
+    return lambda payload: ujson.dumps(payload, sort_keys=True).encode("utf-8")
+
+
+ENCODERS = {
+    "orjson": _orjson_encoder,
+    "ujson": _ujson_encoder,
+    "json": _stdlib_encoder,
+}
+
+
+def make_encoder(name):
+    if name != "auto":
+        return name, ENCODERS[name]()
+
+    for candidate in ("orjson", "ujson", "json"):
+        try:
+            return candidate, ENCODERS[candidate]()
+        except ImportError:
+            continue
+
+
+def setup_serialization(app):
+    app.extensions["json_encoder"] = make_encoder(app.config.get("JSON_ENCODER", "auto"))
+
+
+def json_response(payload):
+    """
+    json_response(payload)
+        drop-in for flask.jsonify(payload) using the configured encoder
+    """
+    name, encode = current_app.extensions["json_encoder"]
+    return current_app.response_class(encode(payload), mimetype="application/json")
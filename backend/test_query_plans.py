@@ -0,0 +1,344 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+import logging
+
+from sqlalchemy import event
+
+from flaskr import create_app, encode_cursor
+from models import db
+from benchmark import seed_database
+
+"""
+query plan regression tests. every request below runs against a
+seeded question bank while its SQL is captured; the test fails when a
+request issues more statements or fetches more rows than its budget,
+scans the whole questions table, skips more rows with OFFSET than
+allowed, or its EXPLAIN plans differ from the snapshot in
+query_plans/<dialect>/. besides warm workers, requests are measured in
+a cold worker's first request and in a worker catching up with another
+worker's write.
+
+    QUERY_PLAN_DATABASE_URI  database to seed, a temporary SQLite file
+                             by default. its questions are replaced
+    QUERY_PLAN_SIZE          questions to seed, 20000 by default
+    QUERY_PLANS_UPDATE=1     write the snapshots instead of comparing
+
+a missing snapshot fails the test. for a dialect with no snapshot
+directory yet, e.g. postgresql, the budgets are still checked but
+plans aren't compared until a QUERY_PLANS_UPDATE=1 run creates and
+commits it
+"""
+
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'query_plans')
+COST_PATTERN = re.compile(r"\s+\(cost=[^)]*\)")
+OFFSET_PATTERN = re.compile(r"\sOFFSET (\?|%\((\w+)\)s)$")
+# the only statement SQLite may answer with a bare SCAN of questions:
+# walking the primary key in order and stopping at the LIMIT
+PRIMARY_KEY_WALK = re.compile(r"\sFROM questions ORDER BY questions\.id\s+LIMIT ")
+
+
+class QueryPlanTestCase(unittest.TestCase):
+    """Statement, row and plan budgets for the trivia endpoints"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.workdir = None
+        database_path = os.getenv('QUERY_PLAN_DATABASE_URI')
+        if database_path is None:
+            cls.workdir = tempfile.mkdtemp(prefix='trivia-plans-')
+            database_path = 'sqlite:///' + os.path.join(cls.workdir, 'trivia.db')
+
+        # caches off, so every measured request reaches the database
+        cls.config = {
+            "SQLALCHEMY_DATABASE_URI": database_path,
+            "RESPONSE_CACHE": None,
+            "SEARCH_CACHE_SIZE": 0
+        }
+        cls.app = create_app(cls.config)
+        cls.size = seed_database(cls.app, int(os.getenv('QUERY_PLAN_SIZE', 20000)), 1234)
+        with cls.app.app_context():
+            cls.engine = db.engine
+        cls.dialect = cls.engine.dialect.name
+
+    @classmethod
+    def tearDownClass(cls):
+        if cls.workdir is not None:
+            shutil.rmtree(cls.workdir, ignore_errors=True)
+
+    def setUp(self):
+        self.client = self.app.test_client
+
+    def worker(self):
+        """another application on the same database, with its own engine"""
+        app = create_app(self.config)
+        with app.app_context():
+            app.engine = db.engine
+        return app
+
+    def capture(self, method, path, body=None, app=None):
+        statements = []
+        engine = self.engine if app is None else app.engine
+        client = self.client() if app is None else app.test_client()
+
+        def record(conn, cursor, statement, parameters, context, executemany):
+            statements.append((statement, parameters))
+
+        event.listen(engine, "before_cursor_execute", record)
+        try:
+            res = client.open(path, method=method, json=body)
+        finally:
+            event.remove(engine, "before_cursor_execute", record)
+        return res, statements
+
+    def explain(self, cursor, statement, parameters):
+        if self.dialect == 'sqlite':
+            cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            depths = {0: -1}
+            lines = []
+            for node, parent, _, detail in cursor.fetchall():
+                depths[node] = depths.get(parent, -1) + 1
+                lines.append("  " * depths[node] + detail)
+            return lines
+
+        cursor.execute("EXPLAIN " + statement, parameters)
+        return [COST_PATTERN.sub("", line) for line, in cursor.fetchall()]
+
+    def full_scans(self, statement, plan):
+        """
+        plan lines that read every row of questions: a Postgres Seq Scan,
+        or a SQLite SCAN without an index, unless it walks the primary
+        key in order up to a LIMIT. a sort, e.g. ORDER BY random(), reads
+        every row before the LIMIT applies, so it is still a full scan
+        """
+        if self.dialect == 'sqlite':
+            walk = (PRIMARY_KEY_WALK.search(statement)
+                    and not any("USE TEMP B-TREE" in line for line in plan))
+            return [
+                line for line in plan
+                if re.match(r"\s*SCAN questions$", line) and not walk]
+        return [line for line in plan if "Seq Scan on questions" in line]
+
+    def skipped_rows(self, statement, parameters):
+        """rows read and thrown away by the statement's OFFSET"""
+        match = OFFSET_PATTERN.search(statement.rstrip())
+        if match is None:
+            return 0
+        if match.group(2):
+            return parameters[match.group(2)]
+        return parameters[-1]
+
+    def analyze(self, statements):
+        rows = 0
+        skipped = 0
+        snapshot = []
+        scans = []
+        connection = self.engine.raw_connection()
+        try:
+            cursor = connection.cursor()
+            for number, (statement, parameters) in enumerate(statements, 1):
+                snapshot.append("-- statement {}".format(number))
+                snapshot.extend(line.rstrip() for line in statement.strip().splitlines())
+                if not statement.lstrip().upper().startswith("SELECT"):
+                    continue
+
+                cursor.execute(
+                    "SELECT count(*) FROM ({}) AS counted".format(statement), parameters)
+                rows += cursor.fetchone()[0]
+                skipped += self.skipped_rows(statement, parameters)
+
+                plan = self.explain(cursor, statement, parameters)
+                snapshot.extend("   " + line for line in plan)
+                scans.extend(self.full_scans(statement, plan))
+        finally:
+            connection.close()
+        return rows, skipped, "\n".join(snapshot) + "\n", scans
+
+    def assert_snapshot(self, name, snapshot):
+        directory = os.path.join(SNAPSHOT_DIR, self.dialect)
+        path = os.path.join(directory, name + ".txt")
+        if os.getenv('QUERY_PLANS_UPDATE') == '1':
+            os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as saved:
+                saved.write(snapshot)
+            logging.info("Wrote query plan snapshot %s", path)
+            return
+
+        if not os.path.isdir(directory):
+            logging.warning("No %s query plan snapshots, not comparing plans", self.dialect)
+            return
+
+        self.assertTrue(
+            os.path.exists(path),
+            "no query plan snapshot {}, rerun with QUERY_PLANS_UPDATE=1 "
+            "and commit it".format(path))
+        with open(path) as saved:
+            self.assertEqual(
+                snapshot, saved.read(),
+                "query plans changed for {}, rerun with QUERY_PLANS_UPDATE=1 "
+                "if intended".format(name))
+
+    def assert_budget(self, name, method, path, body=None, max_statements=1, max_rows=0,
+                      max_skipped=0, max_scans=0, warm=True, app=None):
+        """
+        runs the request once to build indexes and caches when warm,
+        then measures a second run against the budget. app measures
+        another worker instead of the class's one
+        """
+        if warm:
+            (self.client() if app is None else app.test_client()).open(
+                path, method=method, json=body)
+
+        res, statements = self.capture(method, path, body, app)
+        rows, skipped, snapshot, scans = self.analyze(statements)
+
+        logging.info(
+            "%s %s: %d statements, %d rows, %d skipped, %d full scans",
+            method, path, len(statements), rows, skipped, len(scans))
+
+        self.assertLess(res.status_code, 400)
+        self.assertLessEqual(len(statements), max_statements, snapshot)
+        self.assertLessEqual(rows, max_rows, snapshot)
+        self.assertLessEqual(skipped, max_skipped, snapshot)
+        self.assertLessEqual(len(scans), max_scans, snapshot)
+        self.assert_snapshot(name, snapshot)
+        return res
+
+    def write_from_other_worker(self):
+        """inserts a question through another worker, as a foreign write"""
+        res = self.worker().test_client().post('/questions', json={
+            'question': 'Question from another worker?',
+            'answer': 'Other',
+            'category': 3,
+            'difficulty': 2
+        })
+        self.assertEqual(res.status_code, 200)
+
+    # curl http://127.0.0.1:5000/categories
+    def test_retrieve_categories_plan(self):
+        self.assert_budget('retrieve_categories', 'GET', '/categories', max_statements=1, max_rows=1)
+
+    # curl http://127.0.0.1:5000/questions?page=50
+    def test_retrieve_questions_plan(self):
+        # OFFSET paging walks the 490 rows before the page
+        self.assert_budget(
+            'retrieve_questions', 'GET', '/questions?page=50',
+            max_statements=2, max_rows=12, max_skipped=490)
+
+    # curl http://127.0.0.1:5000/questions?after_id=<cursor>
+    def test_retrieve_questions_with_cursor_plan(self):
+        self.assert_budget(
+            'retrieve_questions_with_cursor', 'GET',
+            '/questions?after_id={}'.format(encode_cursor(self.size // 2)),
+            max_statements=2, max_rows=12)
+
+    # curl http://127.0.0.1:5000/categories/3/questions?page=20
+    def test_retrieve_questions_in_category_plan(self):
+        self.assert_budget(
+            'retrieve_questions_in_category', 'GET', '/categories/3/questions?page=20',
+            max_statements=2, max_rows=12, max_skipped=190)
+
+    # curl http://127.0.0.1:5000/questions/search -X POST -H "Content-Type: application/json" -d '{"searchTerm":"river"}'
+    def test_search_questions_plan(self):
+        self.assert_budget(
+            'search_questions', 'POST', '/questions/search', {'searchTerm': 'river'},
+            max_statements=2, max_rows=11)
+
+    # curl "http://127.0.0.1:5000/questions/suggest?q=riv"
+    def test_suggest_questions_plan(self):
+        self.assert_budget('suggest_questions', 'GET', '/questions/suggest?q=riv', max_statements=1, max_rows=1)
+
+    # curl http://127.0.0.1:5000/quizzes -X POST -H "Content-Type: application/json" -d '{"previous_questions": [1, 2, 3], "quiz_category": {"id": 2}}'
+    def test_play_quiz_plan(self):
+        self.assert_budget(
+            'play_quiz', 'POST', '/quizzes',
+            {'previous_questions': [1, 2, 3], 'quiz_category': {'id': 2}},
+            max_statements=2, max_rows=2)
+
+    # curl http://127.0.0.1:5000/quizzes -X POST -H "Content-Type: application/json" -d '{"previous_questions": [], "quiz_category": {"id": 4}, "adaptive": true, "recent_answers": [true, true]}'
+    def test_play_quiz_adaptive_plan(self):
+        self.assert_budget(
+            'play_quiz_adaptive', 'POST', '/quizzes',
+            {'previous_questions': [], 'quiz_category': {'id': 4},
+             'adaptive': True, 'recent_answers': [True, True]},
+            max_statements=2, max_rows=2)
+
+    # curl http://127.0.0.1:5000/quizzes -X POST -H "Content-Type: application/json" -d '{"previous_questions": [], "quiz_category": {"id": 0}, "count": 10}'
+    def test_play_quiz_batch_plan(self):
+        self.assert_budget(
+            'play_quiz_batch', 'POST', '/quizzes',
+            {'previous_questions': [], 'quiz_category': {'id': 0}, 'count': 10},
+            max_statements=2, max_rows=11)
+
+    # curl http://127.0.0.1:5000/questions -X POST -H "Content-Type: application/json" -d '{"question":"Plan question?", "answer":"Plan", "category":1, "difficulty":1}'
+    def test_create_question_plan(self):
+        question = {
+            'question': 'Plan question?',
+            'answer': 'Plan',
+            'category': 1,
+            'difficulty': 1
+        }
+        # build the indexes first, so the write updates them in place
+        self.client().get('/questions')
+        self.assert_budget('create_question', 'POST', '/questions', question, max_statements=6, max_rows=3)
+
+    # curl -X DELETE http://127.0.0.1:5000/questions/<id>
+    def test_delete_question_plan(self):
+        self.client().get('/questions')
+        # not the highest id, whose deletion rebuilds the question counts
+        self.assert_budget(
+            'delete_question', 'DELETE', '/questions/{}'.format(self.size // 3),
+            max_statements=6, max_rows=3, warm=False)
+
+    # a fresh worker's first request, e.g. curl http://127.0.0.1:5000/questions right after startup
+    def test_retrieve_questions_cold_plan(self):
+        self.assert_budget(
+            'retrieve_questions_cold', 'GET', '/questions',
+            max_statements=6, max_rows=26, warm=False, app=self.worker())
+
+    # a fresh worker's first search reads every question into its index.
+    # the other tests add a few questions to the seeded ones
+    def test_search_questions_cold_plan(self):
+        self.assert_budget(
+            'search_questions_cold', 'POST', '/questions/search', {'searchTerm': 'river'},
+            max_statements=4, max_rows=self.size + 20, max_scans=1,
+            warm=False, app=self.worker())
+
+    # a fresh worker's first quiz step reads every question id into its decks
+    def test_play_quiz_cold_plan(self):
+        self.assert_budget(
+            'play_quiz_cold', 'POST', '/quizzes',
+            {'previous_questions': [1, 2, 3], 'quiz_category': {'id': 2}},
+            max_statements=4, max_rows=self.size + 10, max_scans=1,
+            warm=False, app=self.worker())
+
+    # the first listing after another worker's write replays it from question_changes
+    def test_retrieve_questions_after_other_write_plan(self):
+        self.client().get('/questions')
+        self.write_from_other_worker()
+        self.assert_budget(
+            'retrieve_questions_after_other_write', 'GET', '/questions',
+            max_statements=3, max_rows=13, warm=False)
+
+    # the first search after another worker's write replays it from question_changes
+    def test_search_questions_after_other_write_plan(self):
+        self.client().post('/questions/search', json={'searchTerm': 'river'})
+        self.write_from_other_worker()
+        self.assert_budget(
+            'search_questions_after_other_write', 'POST', '/questions/search',
+            {'searchTerm': 'river'}, max_statements=3, max_rows=12, warm=False)
+
+    # the first quiz step after another worker's write replays it from question_changes
+    def test_play_quiz_after_other_write_plan(self):
+        self.client().post('/quizzes', json={'previous_questions': [], 'quiz_category': {'id': 2}})
+        self.write_from_other_worker()
+        self.assert_budget(
+            'play_quiz_after_other_write', 'POST', '/quizzes',
+            {'previous_questions': [1, 2, 3], 'quiz_category': {'id': 2}},
+            max_statements=3, max_rows=3, warm=False)
+
+# Make the tests conveniently executable
+if __name__ == "__main__":
+    unittest.main()